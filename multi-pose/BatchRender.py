@@ -1,3 +1,4 @@
+import collections
 import torch
 import numpy as np
 import torch.nn as nn
@@ -21,6 +22,7 @@ from pytorch3d.renderer import (
 
 from pytorch3d.ops import sample_points_from_meshes
 from CustomRenderers import *
+from utils.utils import hinter_sampling
 
 class BatchRender:
     def __init__(self, obj_paths, device, batch_size=12, faces_per_pixel=16,
@@ -38,9 +40,29 @@ class BatchRender:
         # Setup batch of meshes
         self.vertices, self.faces, self.textures = self.initMeshes()
 
+        # The meshes on the render device, padded to a common size so that batches
+        # of mixed objects can be gathered by object id. The single objects are
+        # views of the padded tensors (see deviceMesh), not separate copies
+        self.num_verts = [len(v) for v in self.vertices]
+        self.num_faces = [len(f) for f in self.faces]
+        self.padded_vertices = list_to_padded([v.to(self.device) for v in self.vertices])
+        self.padded_faces = list_to_padded([f.to(self.device) for f in self.faces], pad_value=-1)
+        self.padded_textures = list_to_padded([t.to(self.device) for t in self.textures])
+
+        # The most recently used single object batches (object id, batch size),
+        # 0 disables the cache
+        self.batch_meshes = collections.OrderedDict()
+        self.max_batch_meshes = 16
+
         # Initialize the renderer
         self.renderer = self.initRender(image_size=image_size, method=self.method)
 
+    def setImageSize(self, image_size):
+        # Rebuild the rasterizer at a new resolution, e.g. for a resolution curriculum
+        if(image_size != self.image_size):
+            self.image_size = image_size
+            self.renderer = self.initRender(image_size=image_size, method=self.method)
+
     def renderBatch(self, Rs, ts, ids=[]):
         if(type(Rs) is list):
             batch_R = torch.tensor(np.stack(Rs), device=self.device, dtype=torch.float32)
@@ -55,18 +77,7 @@ class BatchRender:
             # No ids specified, assuming one object only
             ids = [0 for r in Rs]
 
-        # Load meshes based on object ids
-        batch_verts_rgb = list_to_padded([self.textures[i] for i in ids])
-        batch_textures = TexturesVertex(verts_features=batch_verts_rgb.to(self.device))
-        batch_verts=[self.vertices[i].to(self.device) for i in ids]
-        batch_faces=[self.faces[i].to(self.device) for i in ids]
-
-        mesh = Meshes(
-            verts=batch_verts,
-            faces=batch_faces,
-            textures=batch_textures
-        )
-
+        mesh = self.batchMeshes(ids)
         images = self.renderer(meshes_world=mesh, R=batch_R, T=batch_T)
         if(self.method == "soft-silhouette"):
             images = images[..., 3]
@@ -84,6 +95,97 @@ class BatchRender:
             images = torch.mean(images, dim=3)
         return images
 
+    def batchMeshes(self, ids):
+        # Meshes of the objects ids
+        ids = [int(i) for i in ids]
+        if(len(set(ids)) > 1):
+            # Mixed compositions rarely repeat, gather them from the padded objects.
+            # The padded faces (-1) are dropped by Meshes, the padded vertices are unused.
+            index = torch.tensor(ids, device=self.device, dtype=torch.long)
+            return Meshes(verts=self.padded_vertices[index],
+                          faces=self.padded_faces[index],
+                          textures=TexturesVertex(verts_features=self.padded_textures[index]))
+
+        key = (ids[0], len(ids))
+        if(key in self.batch_meshes):
+            self.batch_meshes.move_to_end(key)
+            return self.batch_meshes[key]
+        mesh = self.objectMeshes(key[0]).extend(key[1])
+        if(self.max_batch_meshes > 0):
+            self.batch_meshes[key] = mesh
+            while(len(self.batch_meshes) > self.max_batch_meshes):
+                self.batch_meshes.popitem(last=False)
+        return mesh
+
+    def cachedMeshTensors(self):
+        # Tensors held by the cached batch meshes, for the memory report
+        return [[vars(m), vars(m.textures)] for m in self.batch_meshes.values()]
+
+    def deviceMesh(self, obj_id):
+        # Vertices, faces and textures of an object on the render device without the padding
+        num_verts = self.num_verts[obj_id]
+        return (self.padded_vertices[obj_id,:num_verts],
+                self.padded_faces[obj_id,:self.num_faces[obj_id]],
+                self.padded_textures[obj_id,:num_verts])
+
+    def objectMeshes(self, obj_id):
+        verts, faces, textures = self.deviceMesh(obj_id)
+        return Meshes(verts=[verts],
+                      faces=[faces],
+                      textures=TexturesVertex(verts_features=[textures]))
+
+    def initPoints(self, num_points=256, num_directions=1000, grid_size=16):
+        # Surface points of each object for the render-free loss (see losses.pointDepthLoss)
+        # and which of them are visible from each direction of a dense view sphere.
+        # A point is visible if it faces the camera and is not more than two grid
+        # cells behind the closest point in its cell of an orthographic point z-buffer.
+        directions = hinter_sampling(num_directions, radius=1)[0].astype(np.float32)
+        points = []
+        visibility = []
+        for obj_id in range(len(self.obj_paths)):
+            verts, facs, _ = self.deviceMesh(obj_id)
+            mesh = Meshes(verts=[verts], faces=[facs])
+            pts, normals = sample_points_from_meshes(mesh, num_points, return_normals=True)
+            pts = pts[0].cpu().numpy()
+            normals = normals[0].cpu().numpy()
+            # Make the normals point outwards regardless of the winding of the faces
+            if(np.sum((pts - pts.mean(0))*normals) < 0):
+                normals = -normals
+
+            # Depth along and position across each viewing direction (D,N)
+            depth = directions.dot(pts.T)
+            up = np.where(np.abs(directions[:,1:2]) < 0.9, [[0.0, 1.0, 0.0]], [[1.0, 0.0, 0.0]])
+            u = np.cross(directions, up)
+            u /= np.linalg.norm(u, axis=1, keepdims=True)
+            v = np.cross(directions, u)
+            extent = np.max(np.linalg.norm(pts - pts.mean(0), axis=1))
+            cell_size = 2.0*extent/grid_size
+            centered = pts - pts.mean(0)
+            cells_u = np.clip(((u.dot(centered.T) + extent)/cell_size).astype(np.int64), 0, grid_size-1)
+            cells_v = np.clip(((v.dot(centered.T) + extent)/cell_size).astype(np.int64), 0, grid_size-1)
+            cells = (np.arange(len(directions))[:,None]*grid_size + cells_u)*grid_size + cells_v
+
+            closest = np.full(len(directions)*grid_size*grid_size, np.inf)
+            np.minimum.at(closest, cells.flatten(), depth.flatten())
+            visible = (depth <= closest[cells] + 2.0*cell_size) & (directions.dot(normals.T) < 0)
+            points.append(pts)
+            visibility.append(visible)
+
+        self.points = {"points": torch.tensor(np.stack(points), device=self.device, dtype=torch.float32),
+                       "visibility": torch.tensor(np.stack(visibility), device=self.device),
+                       "directions": torch.tensor(directions, device=self.device)}
+
+    def visiblePoints(self, Rs, ids):
+        # Object points (M,N,3) and their visibility (M,N) for rotations Rs (M,3,3),
+        # looked up for the closest direction of the view sphere
+        if(len(ids) == 0):
+            ids = [0 for r in Rs]
+        ids = torch.tensor(ids, device=self.device, dtype=torch.long)
+        # The camera looks along the z axis, in object coordinates along the last column of R
+        view_directions = Rs[:,:,2].detach()
+        direction_indices = torch.argmax(torch.matmul(view_directions, self.points["directions"].t()), dim=1)
+        return self.points["points"][ids], self.points["visibility"][ids, direction_indices]
+
     def initMeshes(self):
         textures = []
         vertices = []
@@ -0,0 +1,145 @@
+import os
+import re
+import glob
+import queue
+import threading
+import numpy as np
+import torch
+
+# Background writer for the training checkpoints
+#
+# save() snapshots all tensors of the state to the CPU and returns, the actual
+# torch.save happens on a separate thread. Every checkpoint is written to a
+# temporary file, fsync'ed and then atomically renamed to
+# model-epoch{N}.pt, so latestCheckpoint() never sees a partial file.
+# save_step() writes the step checkpoints within an epoch the same way, they
+# are not subject to the retention policy.
+#
+# After each write the retention policy is applied to the model directory:
+#   keep_last  - keep the N most recent checkpoints (0 keeps everything)
+#   keep_every - additionally keep every Mth epoch (0 disables it)
+#   keep_best  - additionally keep the epoch with the lowest validation loss,
+#                checkpoints that are still to be validated (every validate_every
+#                epochs, after the last validated epoch) are kept until then
+
+def snapshotToCPU(obj):
+    if(torch.is_tensor(obj)):
+        # Copy explicitly, .cpu() returns the same storage for CPU tensors
+        return obj.detach().to("cpu", copy=True)
+    if(isinstance(obj, np.ndarray)):
+        return obj.copy()
+    if(isinstance(obj, dict)):
+        return {k: snapshotToCPU(v) for k,v in obj.items()}
+    if(isinstance(obj, (list, tuple))):
+        return type(obj)(snapshotToCPU(v) for v in obj)
+    return obj
+
+def checkpointEpoch(path):
+    match = re.search(r'model-epoch(\d+)\.pt$', path)
+    if(match is None):
+        return None
+    return int(match.group(1))
+
+def saveAtomic(state, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # Make the rename itself durable
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class CheckpointWriter():
+    def __init__(self, model_dir, keep_last=0, keep_every=0, keep_best=True):
+        self.model_dir = model_dir
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.keep_best = keep_best
+        self.validate_every = 0
+        self.val_losses = {}
+        self.error = None
+
+        # Only a single pending snapshot, saving blocks if the writer falls behind
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def path(self, epoch):
+        return os.path.join(self.model_dir, "model-epoch{0}.pt".format(epoch))
+
+    def save(self, state, epoch):
+        self.check()
+        self.queue.put(("save", snapshotToCPU(state), epoch))
+
+    def save_step(self, state, path):
+        self.check()
+        self.queue.put(("save_step", snapshotToCPU(state), path))
+
+    def set_val_loss(self, epoch, val_loss):
+        # Used by the retention policy to keep the best checkpoint
+        self.queue.put(("val_loss", val_loss, epoch))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+    def check(self):
+        if(self.error is not None):
+            raise RuntimeError("Writing a checkpoint failed:\n{0}".format(self.error))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if(job is None):
+                break
+            try:
+                action, data, target = job
+                if(action == "save_step"):
+                    # target is the path of the step checkpoint
+                    saveAtomic(data, target)
+                    continue
+                if(action == "save"):
+                    self.write(data, target)
+                else:
+                    self.val_losses[target] = data
+                self.apply_retention()
+            except Exception as e:
+                self.error = repr(e)
+
+    def write(self, state, epoch):
+        saveAtomic(state, self.path(epoch))
+
+    def retained_epochs(self, epochs):
+        if(self.keep_last <= 0):
+            return set(epochs)
+        keep = set(sorted(epochs)[-self.keep_last:])
+        if(self.keep_every > 0):
+            keep.update([e for e in epochs if e % self.keep_every == 0])
+        if(self.keep_best):
+            known = [e for e in epochs if e in self.val_losses]
+            if(len(known) > 0):
+                keep.add(min(known, key=lambda e: self.val_losses[e]))
+            if(self.validate_every > 0):
+                # Validation skips the epochs before the last validated one
+                last_validated = max(self.val_losses.keys()) if len(self.val_losses) > 0 else -1
+                keep.update([e for e in epochs if e % self.validate_every == 0 and e > last_validated])
+        return keep
+
+    def apply_retention(self):
+        checkpoints = {}
+        for path in glob.glob(os.path.join(self.model_dir, "model-epoch*.pt")):
+            epoch = checkpointEpoch(path)
+            if(epoch is not None):
+                checkpoints[epoch] = path
+
+        keep = self.retained_epochs(list(checkpoints.keys()))
+        for epoch, path in checkpoints.items():
+            if(epoch not in keep):
+                os.remove(path)
@@ -50,7 +50,8 @@ class DatasetGenerator():
 
     def __init__(self, background_path, obj_paths, obj_distance, batch_size,
                  _, device, sampling_method="sphere", max_rel_offset=0.2, augment_imgs=True,
-                 random_light=True, num_bgs=5000, seed=None):
+                 random_light=True, num_bgs=5000, seed=None, cache_path=None,
+                 cache_shard_size=1000, sample_reuse=1, reuse_buffer_size=1000):
 
         self.random_light = random_light
         self.realistic_occlusions = False
@@ -73,6 +74,21 @@ class DatasetGenerator():
         self.augment = augment_imgs
         self.aug = self.setup_augmentation()
 
+        # Stuff for the on-disk render cache (opened on first use)
+        self.seed = seed
+        self.sampling_method = sampling_method
+        self.cache_path = cache_path
+        self.cache_shard_size = cache_shard_size
+        self.cache_size = None # Number of cached renders, max_samples if not set
+        self.cache = None
+        self.cache_indices = []
+
+        # Stuff for re-using each render k times with new augmentations
+        self.sample_reuse = sample_reuse
+        self.reuse_buffer_size = reuse_buffer_size
+        self.reuse_buffer = []
+        self.reset_reuse_stats()
+
         self.backgrounds = self.load_bg_images("backgrounds", background_path, num_bgs,
                                                self.img_size, self.img_size)
 
@@ -165,7 +181,8 @@ class DatasetGenerator():
             self.pose_sampling = self.reuse_poses
 
     def __len__(self):
-        return int(self.max_samples/self.batch_size)
+        # Number of batches served, the last one is partial if not aligned
+        return int(np.ceil(self.max_samples/self.batch_size))
 
     def reuse_poses(self):
         rand_id = np.random.choice(20*1000,1,replace=False)[0]
@@ -630,6 +647,10 @@ class DatasetGenerator():
 
 
     def generate_image_batch(self, Rin=None, tin=None, augment=True):
+        # Serve renders from the on-disk cache or the reuse buffer if enabled
+        if((self.cache_path is not None or self.sample_reuse > 1) and Rin is None):
+            return self.generate_crop_batch(augment=augment)
+
         # Generate random poses
         curr_Rs = []
         curr_ts = []
@@ -665,28 +686,15 @@ class DatasetGenerator():
             R = R.detach().cpu().numpy()
             t = t.detach().cpu().numpy()
 
-            # Convert R matrix from pytorch to opengl format
-            # for rendering only!
-            xy_flip = np.eye(3, dtype=np.float)
-            xy_flip[0,0] = -1.0
-            xy_flip[1,1] = -1.0
-            R_opengl = np.dot(R,xy_flip)
-            R_opengl = np.transpose(R_opengl)
-
-            # Randomize light position for rendering if enabled
-            if(self.random_light is True):
-                random_light_pos = (np.random.uniform(-1.0, 1.0, size=3)*self.dist[obj_id][-1]).astype(np.float32)
-            else:
-                random_light_pos = None
-
             # Render images
-            ren_rgb = self.renderers[obj_id].render(R_opengl, t, random_light_pos)
+            ren_rgb = self.render_pose(R, t, obj_id)
 
             curr_Rs.append(R)
             curr_ts.append(t)
             curr_ids.append(obj_id)
 
             image_renders.append(ren_rgb)
+        self.reuse_stats["fresh"] += self.batch_size
 
         if(len(self.backgrounds) > 0):
             bg_im_isd = np.random.choice(len(self.backgrounds), self.batch_size, replace=False)
@@ -718,44 +726,216 @@ class DatasetGenerator():
             cropped = extract_square_patch(org_img, obj_bb_off, pad_factor=pad_factor)
 
             if(self.realistic_occlusions):
-                # Apply random renders behind
-                num_behind = np.random.randint(0,4)
-                for n in range(num_behind):
-                    random_int = int(np.random.uniform(0, len(self.random_renders)-1))
-                    behind = self.random_renders[random_int]
-                    sum_img = np.sum(cropped[:,:,:3], axis=2)
-                    mask = sum_img == 0
-                    cropped[mask] = behind[mask]
-
-                # Apply random renders behind
-                num_front = np.random.randint(0,2)
-                for n in range(num_front):
-                    random_int = int(np.random.uniform(0, len(self.random_renders)-1))
-                    front = self.random_renders[random_int]
-                    sum_img = np.sum(front[:,:,:3], axis=2)
-                    mask = sum_img != 0
-                    cropped[mask] = front[mask]
-
-            # Apply background
-            if(len(self.backgrounds) > 0):
-                img_back = self.backgrounds[bg_im_isd[k]]
-                img_back = cv.cvtColor(img_back, cv.COLOR_BGR2RGBA).astype(float)
-                alpha = cropped[:, :, 0:3].astype(float)
-                sum_img = np.sum(cropped[:,:,:3], axis=2)
-                alpha[sum_img > 0] = 1
-
-                cropped[:, :, 0:3] = cropped[:, :, 0:3] * alpha + img_back[:, :, 0:3] * (1 - alpha)
-            else:
-                cropped = cropped[:, :, 0:3]
+                self.apply_occlusions(cropped)
 
-            # Augment data
-            image_aug = np.array([cropped])
-            if augment:
-                image_aug = self.aug(images=image_aug)
+            # Apply background and augment data
+            bg_id = bg_im_isd[k] if len(self.backgrounds) > 0 else None
+            images.append(self.finalize_image(cropped, bg_id, augment))
 
-            ## Convert to float and discard alpha channel
-            image_aug = image_aug[0].astype(np.float)/255.0
-            images.append(image_aug[:,:,:3])
+        data = {"ids":curr_ids,
+                "images":images,
+                "Rs":curr_Rs}
+        return data
+
+    def apply_occlusions(self, cropped):
+        # Apply random renders behind
+        channels = cropped.shape[2]
+        num_behind = np.random.randint(0,4)
+        for n in range(num_behind):
+            random_int = int(np.random.uniform(0, len(self.random_renders)-1))
+            behind = self.random_renders[random_int]
+            sum_img = np.sum(cropped[:,:,:3], axis=2)
+            mask = sum_img == 0
+            cropped[mask] = behind[mask, :channels]
+
+        # Apply random renders in front
+        num_front = np.random.randint(0,2)
+        for n in range(num_front):
+            random_int = int(np.random.uniform(0, len(self.random_renders)-1))
+            front = self.random_renders[random_int]
+            sum_img = np.sum(front[:,:,:3], axis=2)
+            mask = sum_img != 0
+            cropped[mask] = front[mask, :channels]
+
+    def render_pose(self, R, t, obj_id):
+        # Convert R matrix from pytorch to opengl format
+        # for rendering only!
+        xy_flip = np.eye(3, dtype=np.float)
+        xy_flip[0,0] = -1.0
+        xy_flip[1,1] = -1.0
+        R_opengl = np.dot(R,xy_flip)
+        R_opengl = np.transpose(R_opengl)
+
+        # Randomize light position for rendering if enabled
+        if(self.random_light is True):
+            random_light_pos = (np.random.uniform(-1.0, 1.0, size=3)*self.dist[obj_id][-1]).astype(np.float32)
+        else:
+            random_light_pos = None
+
+        return self.renderers[obj_id].render(R_opengl, t, random_light_pos)
+
+    def finalize_image(self, cropped, bg_id, augment):
+        # Apply background
+        if(bg_id is not None):
+            img_back = self.backgrounds[bg_id]
+            img_back = cv.cvtColor(img_back, cv.COLOR_BGR2RGBA).astype(float)
+            alpha = cropped[:, :, 0:3].astype(float)
+            sum_img = np.sum(cropped[:,:,:3], axis=2)
+            alpha[sum_img > 0] = 1
+
+            cropped[:, :, 0:3] = cropped[:, :, 0:3] * alpha + img_back[:, :, 0:3] * (1 - alpha)
+        else:
+            cropped = cropped[:, :, 0:3]
+
+        # Augment data
+        image_aug = np.array([cropped])
+        if augment:
+            image_aug = self.aug(images=image_aug)
+
+        ## Convert to float and discard alpha channel
+        image_aug = image_aug[0].astype(np.float)/255.0
+        return image_aug[:,:,:3]
+
+    def cache_config_hash(self):
+        # Everything that changes the un-augmented renders goes into the hash
+        config = [self.obj_paths, np.array(self.dist).tolist(), self.sampling_method,
+                  self.cache_capacity(), self.img_size, self.render_size,
+                  self.K.tolist(), self.random_light, self.seed]
+        return hashlib.md5(str(config).encode('utf-8')).hexdigest()
+
+    def cache_capacity(self):
+        return self.cache_size if self.cache_size is not None else self.max_samples
+
+    def render_crop(self, R=None):
+        # Sample pose and object like generate_image_batch
+        if(R is None):
+            R = self.pose_sampling()
+        if(len(self.renderers) > 1):
+            obj_id = np.random.randint(0, len(self.renderers), size=1)[0]
+        else:
+            obj_id = 0
+        t = torch.tensor([0.0, 0.0, self.dist[obj_id][-1]])
+
+        R = R.detach().cpu().numpy()
+        t = t.detach().cpu().numpy()
+        ren_rgb = self.render_pose(R, t, obj_id)
+
+        # Crop without offset, the offset is applied in generate_crop_batch
+        ys, xs = np.nonzero(ren_rgb[:,:,0] > 0)
+        obj_bb = calc_2d_bbox(xs,ys,[self.render_size,self.render_size])
+        x, y, w, h = obj_bb
+        cropped = extract_square_patch(ren_rgb, obj_bb)[:,:,:3]
+        crop_scale = float(self.img_size)/int(np.maximum(h, w) * 1.2)
+        bb = np.array([w, h, crop_scale])
+        return cropped, R, obj_id, bb
+
+    def next_crop(self):
+        if(self.cache_path is None):
+            return self.render_crop()
+
+        if(self.cache is None):
+            from RenderCache import RenderCache
+            self.cache = RenderCache(self.cache_path, self.cache_config_hash(),
+                                     self.cache_capacity(), shard_size=self.cache_shard_size,
+                                     img_size=self.img_size)
+
+        if(not self.cache.is_complete()):
+            # Fill the cache while serving the fresh renders
+            cropped, R, obj_id, bb = self.render_crop()
+            self.cache.add(cropped, R, obj_id, bb)
+            return cropped, R, obj_id, bb
+
+        # Replay renders in a new random order every pass
+        if(len(self.cache_indices) == 0):
+            self.cache_indices = list(np.random.permutation(len(self.cache)))
+        return self.cache.get(self.cache_indices.pop())
+
+    def reset_reuse_stats(self):
+        self.reuse_stats = {"fresh":0, "replayed":0}
+
+    def get_reuse_stats(self):
+        return dict(self.reuse_stats)
+
+    def next_crops(self):
+        samples = []
+
+        # Hard samples are rendered fresh, they take the place of replayed
+        # or cached crops and are not added to the reuse buffer or the cache
+        if(self.hard_mining == True):
+            for k in np.arange(self.batch_size):
+                if(len(self.hard_samples) == 0):
+                    break
+                rand = np.random.uniform(low=0.0, high=1.0, size=1)[0]
+                if(rand <= self.hard_sample_ratio):
+                    rani = np.random.uniform(low=0, high=len(self.hard_samples)-1, size=1)[0]
+                    samples.append(self.render_crop(R=self.hard_samples.pop(int(rani))))
+            self.reuse_stats["fresh"] += len(samples)
+
+        # Replay buffered renders, each of them is retired after being used k times
+        # one fresh render per k samples keeps the buffer in balance
+        if(self.sample_reuse > 1):
+            num_replayed = self.batch_size - int(np.ceil(self.batch_size/self.sample_reuse))
+            num_replayed = min(num_replayed, len(self.reuse_buffer), self.batch_size - len(samples))
+            for k in np.arange(num_replayed):
+                i = np.random.randint(0, len(self.reuse_buffer))
+                entry = self.reuse_buffer[i]
+                entry[1] += 1
+                if(entry[1] >= self.sample_reuse):
+                    self.reuse_buffer.pop(i)
+                samples.append(entry[0])
+            self.reuse_stats["replayed"] += num_replayed
+
+        # Fill the rest of the batch with fresh renders
+        while(len(samples) < self.batch_size):
+            sample = self.next_crop()
+            samples.append(sample)
+            self.reuse_stats["fresh"] += 1
+            if(self.sample_reuse > 1):
+                self.reuse_buffer.append([sample, 1])
+        if(len(self.reuse_buffer) > self.reuse_buffer_size):
+            self.reuse_buffer = self.reuse_buffer[-self.reuse_buffer_size:]
+        return samples
+
+    def generate_crop_batch(self, augment=True):
+        curr_Rs = []
+        curr_ids = []
+        crops = []
+        bbs = []
+
+        if(self.hard_mining == True):
+            print("num hard samples: ", len(self.hard_samples))
+
+        for cropped, R, obj_id, bb in self.next_crops():
+            crops.append(np.array(cropped)) # copy, the crop is modified below
+            bbs.append(bb)
+            curr_Rs.append(np.array(R, dtype=np.float64))
+            curr_ids.append(obj_id)
+
+        if(len(self.backgrounds) > 0):
+            bg_im_isd = np.random.choice(len(self.backgrounds), self.batch_size, replace=False)
+
+        images = []
+        for k in np.arange(self.batch_size):
+            cropped = crops[k]
+
+            # Add relative offset when cropping - like Sundermeyer
+            # the crop window has a fixed size, so offsetting the window
+            # equals shifting the cached crop in the opposite direction
+            w, h, crop_scale = bbs[k]
+            if self.max_rel_offset != 0:
+                rand_trans_x = np.random.uniform(-self.max_rel_offset, self.max_rel_offset) * w
+                rand_trans_y = np.random.uniform(-self.max_rel_offset, self.max_rel_offset) * h
+                shift = np.float32([[1, 0, -rand_trans_x*crop_scale],
+                                    [0, 1, -rand_trans_y*crop_scale]])
+                cropped = cv.warpAffine(cropped, shift, (self.img_size, self.img_size),
+                                        flags=cv.INTER_NEAREST, borderValue=0)
+
+            if(self.realistic_occlusions):
+                self.apply_occlusions(cropped)
+
+            # Apply background and augment data
+            bg_id = bg_im_isd[k] if len(self.backgrounds) > 0 else None
+            images.append(self.finalize_image(cropped, bg_id, augment))
 
         data = {"ids":curr_ids,
                 "images":images,
@@ -776,6 +956,45 @@ class DatasetGenerator():
         data["ids"] = data["ids"][:num_samples]
         return data
 
+    def augmenters(self):
+        if(self.aug is None or not hasattr(self.aug, "get_all_children")):
+            return []
+        return [self.aug] + self.aug.get_all_children()
+
+    # Buffers held by the generator, used for the memory report
+    def memory_usage(self):
+        return {"datagen_backgrounds": self.backgrounds,
+                "datagen_poses": self.poses,
+                "datagen_reuse_buffer": [entry[0][0] for entry in self.reuse_buffer],
+                "datagen_cache_pending": self.cache.pending if self.cache is not None else []}
+
+    # Sampling state for resuming in the middle of an epoch, the renderers and
+    # backgrounds are not included as they only depend on the configuration
+    def get_state(self):
+        return {"curr_samples": self.curr_samples,
+                "poses": list(self.poses),
+                "view_sphere_indices": list(self.view_sphere_indices),
+                "random_aug": self.random_aug,
+                "hard_samples": list(self.hard_samples),
+                "cache_indices": list(self.cache_indices),
+                "reuse_buffer": [list(entry) for entry in self.reuse_buffer],
+                "reuse_stats": dict(self.reuse_stats),
+                "aug_rngs": [a.random_state.state for a in self.augmenters()
+                             if hasattr(a.random_state, "state")]}
+
+    def set_state(self, state):
+        self.curr_samples = state["curr_samples"]
+        self.poses = state["poses"]
+        self.view_sphere_indices = state["view_sphere_indices"]
+        self.random_aug = state["random_aug"]
+        self.hard_samples = state["hard_samples"]
+        self.cache_indices = state["cache_indices"]
+        self.reuse_buffer = state["reuse_buffer"]
+        self.reuse_stats = state["reuse_stats"]
+        augmenters = [a for a in self.augmenters() if hasattr(a.random_state, "state")]
+        for a,rng_state in zip(augmenters, state["aug_rngs"]):
+            a.random_state.set_state_(rng_state)
+
     def __iter__(self):
         self.curr_samples = 0
         return self
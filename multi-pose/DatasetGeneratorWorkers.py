@@ -0,0 +1,207 @@
+import traceback
+import random
+import queue
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import imgaug as ia
+
+# Multi-process wrapper around DatasetGeneratorOpenGL.DatasetGenerator
+#
+# Each worker process owns its own DatasetGenerator (and thereby its own
+# EGL/vispy Renderer) and writes finished batches into a ring of shared
+# memory slots. The training loop only receives the slot index together with
+# the (small) poses and ids, and reads the images directly from the shared
+# memory without copying them.
+#
+# A slot handed out by __next__ stays valid until the next call to __next__,
+# after which it is given back to the workers to be refilled.
+#
+# Every epoch draws a seed from np.random, which train.py reseeds per epoch,
+# and hands it to the workers with the free slots. A worker reseeds itself when
+# the seed changes. The sample stream is still not reproducible bit by bit:
+# batches prefetched before the epoch started use the previous seed and the
+# order in which the workers finish their batches varies.
+
+def seedWorker(seed):
+    torch.manual_seed(seed)
+    np.random.seed(seed=seed)
+    ia.seed(seed)
+    random.seed(seed)
+
+def batchWorker(worker_id, num_workers, gen_args, gen_kwargs, max_samples, seed,
+                slots, free_slots, ready_slots, stop_event):
+    try:
+        # Each worker gets its own seed and thereby its own render cache,
+        # which holds its share of the samples of an epoch
+        worker_seed = None
+        if(seed is not None):
+            worker_seed = seed + 1000*worker_id
+            seedWorker(worker_seed)
+
+        from DatasetGeneratorOpenGL import DatasetGenerator
+        generator = DatasetGenerator(*gen_args, **dict(gen_kwargs, seed=worker_seed))
+        generator.max_samples = max_samples
+        generator.cache_size = int(np.ceil(max_samples/num_workers))
+
+        curr_epoch_seed = None
+        while not stop_event.is_set():
+            try:
+                message = free_slots.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if(message is None):
+                break
+            slot, epoch_seed = message
+            if(epoch_seed is not None and epoch_seed != curr_epoch_seed):
+                curr_epoch_seed = epoch_seed
+                seedWorker(epoch_seed + 1000*worker_id)
+
+            data = generator.generate_samples(generator.batch_size)
+            images = slots[slot].numpy()
+            num_images = len(data["images"])
+            for k in range(num_images):
+                images[k] = data["images"][k]
+
+            ready_slots.put((slot, num_images, data["Rs"], data["ids"],
+                             (worker_id, generator.get_reuse_stats())))
+    except Exception:
+        ready_slots.put(("error", worker_id, traceback.format_exc(), None, None))
+
+
+class DatasetGeneratorWorkers():
+
+    def __init__(self, background_path, obj_paths, obj_distance, batch_size,
+                 _, device, seed=None, num_workers=2, prefetch_depth=4, **kwargs):
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.prefetch_depth = prefetch_depth
+        self.seed = seed
+        self.max_samples = 1000
+        self.curr_samples = 0
+        self.epoch_seed = None
+        self.hard_samples = [] # Hard sample mining is not shared between processes
+
+        # Workers always render on the CPU side, the device is only stored
+        self.gen_args = (background_path, obj_paths, obj_distance, batch_size,
+                         "not_used", torch.device("cpu"))
+        self.gen_kwargs = dict(kwargs, seed=seed)
+
+        self.img_size = 128
+        self.ctx = mp.get_context("spawn")
+        self.slots = None
+        self.workers = []
+        self.curr_slot = None
+
+        # Fresh/replayed sample counts as last reported by each worker
+        self.worker_stats = {}
+        self.stats_offset = {"fresh":0, "replayed":0}
+
+    def __len__(self):
+        # Number of batches served, the last one is partial if not aligned
+        return int(np.ceil(self.max_samples/self.batch_size))
+
+    def start(self):
+        if(len(self.workers) > 0):
+            return
+
+        # Ring buffer of batches in shared memory,
+        # at least one slot per worker to keep them all busy
+        self.prefetch_depth = max(self.prefetch_depth, self.num_workers)
+        shape = (self.batch_size, self.img_size, self.img_size, 3)
+        self.slots = [torch.zeros(shape, dtype=torch.float32).share_memory_()
+                      for s in range(self.prefetch_depth)]
+
+        self.free_slots = self.ctx.Queue()
+        self.ready_slots = self.ctx.Queue()
+        self.stop_event = self.ctx.Event()
+        for s in range(self.prefetch_depth):
+            self.free_slots.put((s, self.epoch_seed))
+
+        for w in range(self.num_workers):
+            p = self.ctx.Process(target=batchWorker,
+                                 args=(w, self.num_workers, self.gen_args, self.gen_kwargs,
+                                       self.max_samples, self.seed,
+                                       self.slots, self.free_slots,
+                                       self.ready_slots, self.stop_event),
+                                 daemon=True)
+            p.start()
+            self.workers.append(p)
+        print("Started {0} dataset workers (prefetch depth: {1})".format(self.num_workers,
+                                                                       self.prefetch_depth))
+
+    def close(self):
+        if(len(self.workers) == 0):
+            return
+        self.stop_event.set()
+        for w in self.workers:
+            self.free_slots.put(None)
+        for w in self.workers:
+            w.join(timeout=10.0)
+            if(w.is_alive()):
+                w.terminate()
+        self.workers = []
+        self.slots = None
+        self.curr_slot = None
+
+    def release(self):
+        # Give the previously served slot back to the workers
+        if(self.curr_slot is not None):
+            self.free_slots.put((self.curr_slot, self.epoch_seed))
+            self.curr_slot = None
+
+    def __iter__(self):
+        if(self.seed is not None):
+            self.epoch_seed = int(np.random.randint(2**31 - 1))
+        self.start()
+        self.curr_samples = 0
+        return self
+
+    def get_ready(self):
+        # Workers killed by a signal (e.g. a segfault in EGL or the OOM killer)
+        # can not report an error themselves
+        while True:
+            try:
+                return self.ready_slots.get(timeout=5.0)
+            except queue.Empty:
+                pass
+            for w_id,w in enumerate(self.workers):
+                if(not w.is_alive()):
+                    self.close()
+                    raise RuntimeError("Dataset worker {0} died (exit code: {1})".format(w_id, w.exitcode))
+
+    def __next__(self):
+        self.release()
+        if(self.curr_samples >= self.max_samples):
+            raise StopIteration
+
+        slot, num_images, Rs, ids, stats = self.get_ready()
+        if(slot == "error"):
+            self.close()
+            raise RuntimeError("Dataset worker {0} failed:\n{1}".format(num_images, Rs))
+        self.worker_stats[stats[0]] = stats[1]
+
+        self.curr_slot = slot
+        # The last batch is trimmed so that exactly max_samples are served
+        num_images = min(num_images, self.max_samples - self.curr_samples)
+        self.curr_samples += num_images
+        data = {"ids":ids[:num_images],
+                "images":self.slots[slot].numpy()[:num_images],
+                "Rs":Rs[:num_images]}
+        return data
+
+    def get_reuse_stats(self):
+        stats = {}
+        for k in self.stats_offset.keys():
+            stats[k] = sum([s[k] for s in self.worker_stats.values()]) - self.stats_offset[k]
+        return stats
+
+    def reset_reuse_stats(self):
+        stats = self.get_reuse_stats()
+        for k in self.stats_offset.keys():
+            self.stats_offset[k] += stats[k]
+
+    def __del__(self):
+        if(hasattr(self, "workers")):
+            self.close()
@@ -0,0 +1,123 @@
+import os
+import json
+import numpy as np
+import torch
+
+# Precomputed training set for training only the pose head
+#
+# buildHeadOnlyDataset() runs a DatasetGenerator once and stores everything
+# that does not depend on the pose head in memory-mapped arrays:
+#   codes.npy - float32 normalized encoder codes (N, 128)
+#   Rs.npy    - float32 GT rotation matrices (N, 3, 3) in Pytorch3D format
+#   ids.npy   - int64 object ids (N,)
+#   depth.npy - float32 GT depth renders (N, H, W) of the loss renderer
+# Training then only needs the pose head and the renders of the predicted poses.
+
+def buildHeadOnlyDataset(generator, pipeline, renderer, translations, num_samples, output_dir):
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    arrays = None
+    num_written = 0
+    generator.max_samples = num_samples
+    with torch.no_grad():
+        for batch in generator:
+            num = min(len(batch["Rs"]), num_samples - num_written)
+            images = batch["images"][:num]
+            Rs = batch["Rs"][:num]
+            ids = batch["ids"][:num]
+
+            codes = pipeline.encode(images)
+            ts = [np.array(translations[i], dtype=np.float32) for i in ids]
+            Rs_gt = torch.tensor(np.stack(Rs), device=renderer.device, dtype=torch.float32)
+            depth = renderer.renderBatch(Rs_gt, ts, ids).float().cpu().numpy()
+
+            if(arrays is None):
+                arrays = {}
+                for key,example,dtype in [("codes", codes, np.float32),
+                                          ("Rs", Rs_gt.cpu().numpy(), np.float32),
+                                          ("ids", np.array(ids), np.int64),
+                                          ("depth", depth, np.float32)]:
+                    arrays[key] = np.lib.format.open_memmap(os.path.join(output_dir, "{0}.npy".format(key)),
+                                                            mode="w+", dtype=dtype,
+                                                            shape=(num_samples,) + example.shape[1:])
+
+            end = num_written + num
+            arrays["codes"][num_written:end] = codes
+            arrays["Rs"][num_written:end] = Rs_gt.cpu().numpy()
+            arrays["ids"][num_written:end] = ids
+            arrays["depth"][num_written:end] = depth
+            num_written = end
+            print("Precomputed samples: {0}/{1}".format(num_written, num_samples))
+            if(num_written >= num_samples):
+                break
+
+    for a in arrays.values():
+        a.flush()
+    with open(os.path.join(output_dir, "info.json"), "w") as f:
+        json.dump({"num_samples": num_written,
+                   "image_size": renderer.image_size}, f)
+    return num_written
+
+class HeadOnlyDataset():
+    def __init__(self, data_path, batch_size, device):
+        self.batch_size = batch_size
+        self.device = device
+        with open(os.path.join(data_path, "info.json")) as f:
+            self.info = json.load(f)
+        self.codes = np.load(os.path.join(data_path, "codes.npy"), mmap_mode='r')
+        self.Rs = np.load(os.path.join(data_path, "Rs.npy"), mmap_mode='r')
+        self.ids = np.load(os.path.join(data_path, "ids.npy"), mmap_mode='r')
+        self.depth = np.load(os.path.join(data_path, "depth.npy"), mmap_mode='r')
+        self.max_samples = len(self.ids)
+        self.hard_samples = []
+        self.indices = []
+        self.rank = 0
+        self.world_size = 1
+        self.seed = 0
+        self.epoch = 0
+
+    def __len__(self):
+        return int(np.ceil(self.max_samples/self.batch_size))
+
+    def shard(self, rank, world_size, seed):
+        # Disjoint samples for every process, like the DistributedSampler.
+        # Every process gets the same number of samples to keep the steps in sync
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.max_samples = min(self.max_samples, len(self.ids)//world_size)
+        return self
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    # Position within the epoch for the step checkpoints, the arrays are memory-mapped
+    def get_state(self):
+        return {"indices": np.array(self.indices, dtype=np.int64)}
+
+    def set_state(self, state):
+        self.indices = list(state["indices"])
+
+    def __iter__(self):
+        # A new random subset and order every epoch
+        if(self.world_size > 1):
+            # The same permutation on every process, each takes its own part
+            rng = np.random.RandomState(self.seed + self.epoch)
+            permutation = rng.permutation(len(self.ids))[self.rank::self.world_size]
+        else:
+            permutation = np.random.permutation(len(self.ids))
+        self.indices = list(permutation[:self.max_samples])
+        return self
+
+    def __next__(self):
+        if(len(self.indices) == 0):
+            raise StopIteration
+        # Sorted indices keep the reads from the memory maps sequential
+        batch_indices = np.sort(self.indices[:self.batch_size])
+        self.indices = self.indices[self.batch_size:]
+        return {"images": None,
+                "codes": torch.from_numpy(self.codes[batch_indices]).to(self.device),
+                "Rs": list(self.Rs[batch_indices]),
+                "ids": self.ids[batch_indices].tolist(),
+                "gt_images": torch.from_numpy(self.depth[batch_indices]).to(self.device)}
@@ -0,0 +1,113 @@
+import os
+import pickle
+import numpy as np
+
+# Validation sets, either from the original pickles or from the compact
+# memory-mapped format written by convert-validation.py:
+#   images.npy - uint8 images (N, H, W, 3), each scaled by its maximum
+#   Rs.npy     - float32 rotation matrices (N, 3, 3) in Pytorch3D format
+#   ids.npy    - int64 object ids (N,)
+# Batches are only sliced (and converted to float) when they are used.
+
+def convertPose(R):
+    # Convert from T-LESS to Pytorch3D format
+    xy_flip = np.eye(3, dtype=np.float32)
+    xy_flip[0,0] = -1.0
+    xy_flip[1,1] = -1.0
+    return np.dot(np.transpose(R), xy_flip).astype(np.float32)
+
+def isCompactDataset(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "images.npy"))
+
+def convertPickle(pickle_path, output_dir, obj_id=0):
+    with open(pickle_path, "rb") as f:
+        data = pickle.load(f, encoding="latin1")
+    num_samples = len(data["Rs"])
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    img_shape = np.array(data["images"][0]).shape
+    images = np.lib.format.open_memmap(os.path.join(output_dir, "images.npy"), mode="w+",
+                                       dtype=np.uint8, shape=(num_samples,) + img_shape)
+    for i in range(num_samples):
+        img = np.array(data["images"][i], dtype=np.float32)
+        images[i] = np.round(img/np.max(img)*255.0).astype(np.uint8)
+    images.flush()
+    del images
+
+    Rs = np.stack([convertPose(R) for R in data["Rs"]])
+    np.save(os.path.join(output_dir, "Rs.npy"), Rs)
+    ids = np.array(data.get("ids", [obj_id]*num_samples), dtype=np.int64)
+    np.save(os.path.join(output_dir, "ids.npy"), ids)
+    return num_samples
+
+class ValidationSet():
+    def __init__(self, images, Rs, ids, batch_size, scale=1.0):
+        self.images = images
+        self.Rs = Rs
+        self.ids = ids
+        self.scale = scale
+        self.batches = [(s, min(s+batch_size, len(Rs))) for s in range(0, len(Rs), batch_size)]
+        self.padding = set() # Batches only repeated to even out the shards
+        self.codes = {} # Cached latent codes per batch
+
+    @classmethod
+    def from_compact(cls, path, batch_size, obj_id):
+        images = np.load(os.path.join(path, "images.npy"), mmap_mode='r')
+        Rs = np.load(os.path.join(path, "Rs.npy"), mmap_mode='r')
+        # The object id is given by the position in VALID_DATA_PATH, as for the pickles,
+        # the stored ids must agree with it
+        ids = np.full(len(Rs), obj_id, dtype=np.int64)
+        ids_path = os.path.join(path, "ids.npy")
+        if(os.path.exists(ids_path)):
+            stored_ids = np.load(ids_path)
+            if(len(stored_ids) != len(Rs) or np.any(stored_ids != obj_id)):
+                raise ValueError("The object ids in {0} ({1}) do not match the object id {2} of its position in VALID_DATA_PATH".format(
+                    ids_path, np.unique(stored_ids).tolist(), obj_id))
+        return cls(images, Rs, ids, batch_size, scale=1.0/255.0)
+
+    @classmethod
+    def from_pickle(cls, path, batch_size, obj_id):
+        with open(path, "rb") as f:
+            data = pickle.load(f, encoding="latin1")
+        images = np.stack([np.array(img, dtype=np.float32)/np.max(img) for img in data["images"]])
+        Rs = np.stack([convertPose(R) for R in data["Rs"]])
+        ids = np.full(len(Rs), obj_id, dtype=np.int64)
+        return cls(images, Rs, ids, batch_size)
+
+    def shard(self, rank, world_size):
+        # Keep every world_size-th batch, used for distributed validation.
+        # Every rank has to run the same number of batches for the collectives
+        # of the model, shorter shards are padded by repeating the last batch,
+        # whose losses are not counted
+        num_batches = int(np.ceil(len(self.batches)/world_size))
+        shard = self.batches[rank::world_size]
+        num_padding = num_batches - len(shard)
+        if(num_padding > 0):
+            shard = shard + [self.batches[-1]]*num_padding
+        self.padding = set(range(len(shard) - num_padding, len(shard)))
+        self.batches = shard
+        return self
+
+    def subsample(self, every):
+        # Keep every n-th batch to reduce the validation cost, done before sharding
+        self.batches = self.batches[::every]
+        return self
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, k):
+        start, end = self.batches[k]
+        batch = {"images": self.images[start:end].astype(np.float32)*self.scale,
+                 "Rs": list(self.Rs[start:end]),
+                 "ids": self.ids[start:end].tolist()}
+        if(k in self.padding):
+            batch["padding"] = True
+        if(k in self.codes):
+            batch["codes"] = self.codes[k]
+        return batch
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
@@ -0,0 +1,82 @@
+import collections
+import numpy as np
+import torch
+
+# Bounded LRU cache of the ground truth renders of the loss
+#
+# The entries are keyed by the object id, the translation, the rotation
+# quantized to a grid of the given angular resolution and the render size.
+# A hit returns the render of the first rotation seen in the same grid cell,
+# so the GT can be off by up to the resolution, a resolution of 0 only reuses
+# renders of exactly the same rotation. Without gradients (validation) the
+# rotations are always matched exactly, so the validation losses are not
+# affected by the resolution. Only the misses of a batch are
+# rendered. The renders are kept on the render device ("device") or in
+# page-locked host memory ("pinned") to leave the GPU memory to training.
+
+class GTRenderCache():
+    def __init__(self, max_entries=10000, resolution=0.5, storage="device"):
+        self.max_entries = max_entries
+        self.step = np.radians(resolution)
+        self.storage = storage
+        self.entries = collections.OrderedDict()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits/total if total > 0 else 0.0,
+                "entries": len(self.entries)}
+
+    def key(self, R, t, obj_id, image_size, exact=False):
+        # A rotation by a small angle a changes the matrix entries by at most a
+        quantized = self.step > 0 and not exact
+        if(quantized):
+            R = np.round(R/self.step).astype(np.int64)
+        return (obj_id, image_size, quantized, np.round(t, 3).tobytes(), R.tobytes())
+
+    def store(self, image):
+        image = image.detach()
+        if(self.storage == "pinned"):
+            image = image.cpu()
+            if(torch.cuda.is_available()):
+                image = image.pin_memory()
+        return image
+
+    def render(self, renderer, Rs, ts, ids=[]):
+        if(len(ids) == 0):
+            ids = [0 for r in Rs]
+        Rs_np = Rs.detach().cpu().numpy()
+        ts_np = [np.asarray(t.cpu() if torch.is_tensor(t) else t, dtype=np.float32) for t in ts]
+        exact = not torch.is_grad_enabled()
+        keys = [self.key(Rs_np[i], ts_np[i], int(ids[i]), renderer.image_size, exact=exact) for i in range(len(ids))]
+
+        # Render each missing entry once, even if it occurs several times in the batch
+        missing = collections.OrderedDict()
+        images = {}
+        for i,k in enumerate(keys):
+            if(k in self.entries):
+                self.entries.move_to_end(k)
+                images[k] = self.entries[k]
+                self.hits += 1
+            else:
+                missing.setdefault(k, i)
+                self.misses += 1
+        if(len(missing) > 0):
+            indices = list(missing.values())
+            rendered = renderer.renderBatch(Rs[indices].detach(), [ts_np[i] for i in indices],
+                                            [ids[i] for i in indices])
+            for k,image in zip(missing.keys(), rendered):
+                images[k] = image.detach()
+                self.entries[k] = self.store(image)
+            while(len(self.entries) > self.max_entries):
+                self.entries.popitem(last=False)
+
+        return torch.stack([images[k].to(renderer.device, non_blocking=True) for k in keys])
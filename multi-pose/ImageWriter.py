@@ -0,0 +1,75 @@
+import os
+import numpy as np
+import torch.multiprocessing as mp
+
+# Renders the SAVE_IMAGES debug figures in a pool of worker processes
+#
+# The trainer only hands over small numpy copies of the first image of a
+# batch. If the workers fall behind, new figures are dropped instead of
+# stalling the training loop.
+
+def saveBatchImage(file_name, num_views, input_images, gt_images, predicted_images,
+                   predicted_poses, batch_loss, batch_size, threshold):
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.pyplot as plt
+    from utils.utils import plotView, prepareDir
+
+    prepareDir(os.path.dirname(file_name))
+    vmin = 0.0
+    vmax = max(np.max(gt_images[0]), np.max(predicted_images[0]))
+
+    fig = plt.figure(figsize=(12,3+num_views*2))
+    plotView(0, num_views, vmin, vmax, input_images, gt_images, predicted_images,
+             predicted_poses, batch_loss, batch_size, threshold=threshold)
+    fig.tight_layout()
+    fig.savefig(file_name, dpi=fig.dpi)
+    plt.close(fig)
+
+class ImageWriter():
+    def __init__(self, num_workers=1, max_pending=8, every=1):
+        self.max_pending = max_pending
+        self.every = every
+        self.pending = []
+        self.dropped = 0
+        self.pool = mp.get_context("spawn").Pool(num_workers)
+
+    def should_save(self, batch_num):
+        return batch_num % self.every == 0
+
+    def submit(self, file_name, num_views, input_images, gt_images, predicted_images,
+               predicted_poses, batch_loss, batch_size, threshold):
+        self.collect()
+        if(len(self.pending) >= self.max_pending):
+            self.dropped += 1
+            return False
+
+        # Only the first image of the batch is plotted
+        args = (file_name, num_views,
+                np.array(input_images[:1]),
+                gt_images[:1].detach().cpu().numpy(),
+                predicted_images[:1].detach().cpu().numpy(),
+                predicted_poses[:1].detach().cpu().numpy(),
+                batch_loss[:1].detach().cpu().numpy(),
+                batch_size, threshold)
+        self.pending.append(self.pool.apply_async(saveBatchImage, args))
+        return True
+
+    def collect(self):
+        still_pending = []
+        for r in self.pending:
+            if(not r.ready()):
+                still_pending.append(r)
+            elif(not r.successful()):
+                try:
+                    r.get()
+                except Exception as e:
+                    print("Saving a debug image failed: {0}".format(e))
+        self.pending = still_pending
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.collect()
+        if(self.dropped > 0):
+            print("Dropped {0} debug images, the image workers could not keep up".format(self.dropped))
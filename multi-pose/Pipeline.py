@@ -2,39 +2,56 @@ import torch
 import numpy as np
 import copy
 
+from utils.utils import autocastContext
+from utils.timing import timer
+
 class Pipeline():
-    def __init__(self, encoder, model, device):
+    def __init__(self, encoder, model, device, precision="fp32"):
         self.encoder = encoder
         self.model = model
         self.device = device
+        self.precision = precision
 
     # Input: x = images as list of numpy arrays
-    # Output: y = pose as 6D representation
+    # Output: y = pose as 6D representation (always fp32)
     def process(self, images):
+        return self.predict(self.encode(images))
+
+    # Input: x = images as list of numpy arrays
+    # Output: y = latent codes as numpy array, the pre-dense features if fine-tuning the encoder
+    def encode(self, images):
         # Disable gradients for the encoder
-        with torch.no_grad():
+        with torch.no_grad(), autocastContext(self.device, self.precision):
             # Pass image through the encoder
             codes = []
             for img in images:
-                # Normalize image
-                img_max = np.max(img)
-                img_min = np.min(img)
-                if(img_max > img_min): # avoids divide by zero issue
-                    img = (img - img_min)/(img_max - img_min)
+                with timer.phase("normalization"):
+                    # Normalize image
+                    img_max = np.max(img)
+                    img_min = np.min(img)
+                    if(img_max > img_min): # avoids divide by zero issue
+                        img = (img - img_min)/(img_max - img_min)
 
-                # Prepare the images for the encoder
-                img = torch.from_numpy(img).unsqueeze(0).permute(0,3,1,2).to(self.device)
+                    # Prepare the images for the encoder
+                    img = torch.from_numpy(img).unsqueeze(0).permute(0,3,1,2).to(self.device)
 
                 # Run through the encoder
-                code = self.encoder(img.float())
-                code = code.detach().cpu().numpy()[0]
+                with timer.phase("encoder"):
+                    code = self.encoder(img.float())
+                    code = code.float().detach().cpu().numpy()[0]
 
                 # Normalize output if NOT fine-tuning the encoder
-                if(self.model.finetune_encoder is False):
+                if(getattr(self.model, "module", self.model).finetune_encoder is False):
                     code = code / np.linalg.norm(code)
                 codes.append(code)
+        return np.stack(codes)
+
+    # Input: x = latent codes from encode(), numpy array or tensor
+    # Output: y = pose as 6D representation (always fp32)
+    def predict(self, codes):
+        with timer.phase("pose_head"), autocastContext(self.device, self.precision):
+            batch_codes = torch.as_tensor(codes, device=self.device, dtype=torch.float32)
+            predicted_poses = self.model(batch_codes)
 
-        # Predict poses from the codes
-        batch_codes = torch.tensor(np.stack(codes), device=self.device, dtype=torch.float32)
-        predicted_poses = self.model(batch_codes)
-        return predicted_poses
+        # The rotation conversion and the loss are done in fp32
+        return predicted_poses.float()
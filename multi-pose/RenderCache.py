@@ -0,0 +1,99 @@
+import os
+import json
+import glob
+import numpy as np
+
+# On-disk cache of un-augmented renders used by DatasetGeneratorOpenGL
+#
+# Samples are stored as memory-mapped .npy shards in a directory named after
+# a hash of the generator configuration:
+#   shard-XXXX-images.npy - uint8 crops (N, H, W, 3) without offset, background or augmentation
+#   shard-XXXX-Rs.npy     - float32 rotation matrices (N, 3, 3) in Pytorch3D format
+#   shard-XXXX-ids.npy    - int64 object ids (N,)
+#   shard-XXXX-bbs.npy    - float32 (N, 3) bounding box width and height in render
+#                           pixels and the render-to-crop scale factor
+# A shard is written to temporary files and renamed once it is complete, so an
+# interrupted run only loses the samples of the current shard.
+
+class RenderCache():
+    def __init__(self, cache_dir, config_hash, num_samples, shard_size=1000, img_size=128):
+        self.path = os.path.join(cache_dir, "renders-{0}".format(config_hash))
+        self.num_samples = num_samples
+        self.shard_size = shard_size
+        self.img_size = img_size
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self.shards = []
+        self.load()
+        self.reset_pending()
+
+    def __len__(self):
+        return sum([len(s["ids"]) for s in self.shards])
+
+    def is_complete(self):
+        return len(self) >= self.num_samples
+
+    def reset_pending(self):
+        self.pending = {"images":[], "Rs":[], "ids":[], "bbs":[]}
+
+    def shard_name(self, shard_num, key):
+        return os.path.join(self.path, "shard-{0:04d}-{1}.npy".format(shard_num, key))
+
+    def load(self):
+        self.shards = []
+        shard_num = 0
+        while os.path.exists(self.shard_name(shard_num, "bbs")):
+            shard = {}
+            for key in ["images", "Rs", "ids", "bbs"]:
+                shard[key] = np.load(self.shard_name(shard_num, key), mmap_mode='r')
+            self.shards.append(shard)
+            shard_num += 1
+        if(len(self.shards) > 0):
+            print("Loaded {0} cached renders from: {1}".format(len(self), self.path))
+
+    def add(self, image, R, obj_id, bb):
+        if(self.is_complete()):
+            return
+        self.pending["images"].append(image[:,:,:3].astype(np.uint8))
+        self.pending["Rs"].append(np.array(R, dtype=np.float32))
+        self.pending["ids"].append(obj_id)
+        self.pending["bbs"].append(np.array(bb, dtype=np.float32))
+
+        remaining = self.num_samples - len(self)
+        if(len(self.pending["ids"]) >= min(self.shard_size, remaining)):
+            self.flush()
+
+    def flush(self):
+        if(len(self.pending["ids"]) == 0):
+            return
+        shard_num = len(self.shards)
+
+        # Write the bounding boxes last, their presence marks a complete shard
+        for key in ["images", "Rs", "ids", "bbs"]:
+            tmp_name = self.shard_name(shard_num, key) + ".tmp"
+            with open(tmp_name, "wb") as f:
+                np.save(f, np.stack(self.pending[key]))
+            os.replace(tmp_name, self.shard_name(shard_num, key))
+        self.reset_pending()
+        self.load()
+
+        if(self.is_complete()):
+            with open(os.path.join(self.path, "info.json"), "w") as f:
+                json.dump({"num_samples": len(self),
+                           "num_shards": len(self.shards)}, f)
+            print("Render cache complete: {0}".format(self.path))
+
+    def get(self, index):
+        for s in self.shards:
+            num = len(s["ids"])
+            if(index < num):
+                return s["images"][index], s["Rs"][index], int(s["ids"][index]), s["bbs"][index]
+            index -= num
+        raise IndexError("Render cache index out of range")
+
+    def clear(self):
+        for f in glob.glob(os.path.join(self.path, "*")):
+            os.remove(f)
+        self.shards = []
+        self.reset_pending()
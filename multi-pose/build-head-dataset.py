@@ -0,0 +1,73 @@
+import os
+import json
+import argparse
+import configparser
+import numpy as np
+import torch
+
+from Pipeline import Pipeline
+from DatasetGeneratorOpenGL import DatasetGenerator
+from DatasetHeadOnly import buildHeadOnlyDataset
+from train import setupModels
+from utils.utils import prepareViews
+
+# Precomputes the training set for head-only training (see DatasetHeadOnly.py),
+# the output directory is used as [Training] HEAD_ONLY_DATA in the experiment config.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("experiment_name")
+    parser.add_argument("-o", help="output directory", required=True)
+    parser.add_argument("-n", help="number of samples, defaults to NUM_SAMPLES", type=int, default=None)
+    parser.add_argument("-d", help="device", default="cuda:0")
+    arguments = parser.parse_args()
+
+    if(arguments.experiment_name.startswith('./experiments')):
+        cfg_file_path = arguments.experiment_name
+    else:
+        cfg_file_path = os.path.join("./experiments", arguments.experiment_name)
+    args = configparser.ConfigParser()
+    args.read(cfg_file_path)
+
+    seed = args.getint('Training', 'RANDOM_SEED')
+    torch.manual_seed(seed)
+    np.random.seed(seed=seed)
+
+    device = torch.device(arguments.d)
+    if(device.type == "cuda"):
+        torch.cuda.set_device(device)
+
+    # The head is not trained here, but it has to match the one of the experiment
+    views = prepareViews(json.loads(args.get('Rendering', 'VIEWS')))
+    br, model, encoder = setupModels(args, device, views)
+    if(model.finetune_encoder):
+        raise ValueError("Head-only training requires FINETUNE_ENCODER to be disabled")
+    encoder.eval()
+    pipeline = Pipeline(encoder, model, device)
+
+    # Handle loading of multiple object paths and translations
+    try:
+        model_path_data = json.loads(args.get('Dataset', 'MODEL_PATH_DATA'))
+        translations = np.array(json.loads(args.get('Rendering', 'T')))
+    except:
+        model_path_data = [args.get('Dataset', 'MODEL_PATH_DATA')]
+        translations = [np.array(json.loads(args.get('Rendering', 'T')))]
+
+    generator = DatasetGenerator(args.get('Dataset', 'BACKGROUND_IMAGES'),
+                                 model_path_data,
+                                 translations,
+                                 args.getint('Training', 'BATCH_SIZE'),
+                                 "not_used",
+                                 device,
+                                 sampling_method = args.get('Training', 'VIEW_SAMPLING'),
+                                 max_rel_offset = args.getfloat('Training', 'MAX_REL_OFFSET', fallback=0.2),
+                                 augment_imgs = args.getboolean('Training', 'AUGMENT_IMGS', fallback=True),
+                                 seed=seed)
+
+    num_samples = arguments.n
+    if(num_samples is None):
+        num_samples = args.getint('Training', 'NUM_SAMPLES')
+    num_written = buildHeadOnlyDataset(generator, pipeline, br, translations, num_samples, arguments.o)
+    print("Wrote {0} samples to: {1}".format(num_written, arguments.o))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import os
+import argparse
+
+from DatasetValidation import convertPickle
+
+# Converts validation pickles to the compact memory-mapped format,
+# the output directories can be used directly in VALID_DATA_PATH.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pickles", nargs='+', help="validation pickles to convert")
+    parser.add_argument("-o", help="output directory, defaults to next to the pickles", default=None)
+    parser.add_argument("-id", help="object id stored if the pickle has none", type=int, default=0)
+    args = parser.parse_args()
+
+    for p in args.pickles:
+        name = os.path.splitext(os.path.basename(p))[0]
+        if(args.o is None):
+            output_dir = os.path.join(os.path.dirname(p), name)
+        else:
+            output_dir = os.path.join(args.o, name)
+        num_samples = convertPickle(p, output_dir, obj_id=args.id)
+        print("Converted {0} samples: {1} -> {2}".format(num_samples, p, output_dir))
+
+if __name__ == '__main__':
+    main()
@@ -64,6 +64,8 @@ def main():
     parser.add_argument("-op", help="path to the CAD model for the object", default=None)
     parser.add_argument("-o", help="output path", default="./output.csv")
     parser.add_argument("-oid", help="where get the obj IDs from (GT or model)", default=None)
+    parser.add_argument("-d", help="device to run the model on", default="cuda:0")
+    parser.add_argument("-pr", help="precision (fp32, bf16 or fp16), defaults to the training config", default=None)
     args = parser.parse_args()
 
     if(args.oid is not None and args.oid == "model"):
@@ -106,9 +108,10 @@ def main():
     # Run prepare our model if needed
     if("Rs_predicted" not in data):
 
-        # Set the cuda device
-        device = torch.device("cuda:0")
-        torch.cuda.set_device(device)
+        # Set the device
+        device = torch.device(args.d)
+        if(device.type == "cuda"):
+            torch.cuda.set_device(device)
 
         # Initialize the model
         model = Model(num_views=num_views,
@@ -118,7 +121,7 @@ def main():
         model.to(device)
 
         # Load model checkpoint
-        checkpoint = torch.load(args.mp)
+        checkpoint = torch.load(args.mp, map_location=device)
 
         # Load model
         model.load_state_dict(checkpoint['model'], strict=False)
@@ -131,7 +134,10 @@ def main():
         encoder.eval()
 
         # Setup the pipeline
-        pipeline = Pipeline(encoder, model, device)
+        precision = args.pr
+        if(precision is None):
+            precision = conf.get('Training', 'PRECISION', fallback='fp32')
+        pipeline = Pipeline(encoder, model, device, precision=precision)
 
     # Prepare renderer if defined
     obj_path = args.op
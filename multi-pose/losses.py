@@ -2,6 +2,7 @@ import torch
 import numpy as np
 from utils.utils import *
 from utils.tools import *
+from utils.timing import timer
 import configparser
 
 from pytorch3d.renderer import look_at_rotation
@@ -12,6 +13,194 @@ def dbg(message, flag):
     if flag:
         print(message)
 
+# The predicted poses of all views are rendered together as one batch of B*V
+# images instead of V batches of B images, max_batch limits the number of
+# images per render call to bound the memory of the rasterizer.
+
+def predictedRotations(poses, pose_start, num_views, pose_rep_func, fixed_gt_images=None):
+    # Rotation matrices of all views (B,V,3,3), view i is poses[:,pose_start+6*i:pose_start+6*(i+1)]
+    if fixed_gt_images is not None:
+        pose_matrix = poses[:,1:].reshape(1,1,3,3)
+        return pose_matrix.expand(-1,num_views,-1,-1)
+    batch_size = poses.shape[0]
+    curr_poses = poses[:,pose_start:pose_start+num_views*6].reshape(batch_size*num_views, 6)
+    return pose_rep_func(curr_poses).reshape(batch_size, num_views, 3, 3)
+
+def renderViews(renderer, Rs, ts, ids, max_batch=0):
+    # Renders (B,V,3,3) rotations, returns the images as (B,V,H,W,...)
+    batch_size, num_views = Rs.shape[:2]
+    # View-major order, so the images of one view are next to each other
+    flat_Rs = Rs.transpose(0,1).reshape(num_views*batch_size, 3, 3)
+    if(torch.is_tensor(ts)):
+        flat_ts = ts.repeat(num_views, 1)
+    else:
+        flat_ts = list(ts)*num_views
+    flat_ids = list(ids)*num_views
+
+    num_images = num_views*batch_size
+    if(max_batch <= 0):
+        max_batch = num_images
+    images = []
+    for start in range(0, num_images, max_batch):
+        end = min(start + max_batch, num_images)
+        images.append(renderer.renderBatch(flat_Rs[start:end], flat_ts[start:end], flat_ids[start:end]))
+    images = torch.cat(images, dim=0)
+    images = images.reshape((num_views, batch_size) + images.shape[1:])
+    return images.transpose(0,1)
+
+def renderGroundTruth(renderer, Rs_gt, ts, ids, gt_cache=None):
+    # Only the renders missing in the cache are rendered, see GTRenderCache.py
+    if gt_cache is not None:
+        return gt_cache.render(renderer, Rs_gt, ts, ids)
+    return renderer.renderBatch(Rs_gt, ts, ids)
+
+def stackViews(images):
+    # (B,V,H,W,...) -> (B,V*H,W,...), the views below each other
+    return images.reshape((images.shape[0], images.shape[1]*images.shape[2]) + images.shape[3:])
+
+def maskedDepthLoss(gt_imgs, imgs, depth_max, background=-1, gt_mask_only=False):
+    # Mean clamped depth difference per view (B,V) over the union of the visible pixels,
+    # or only the visible pixels of the GT with gt_mask_only
+    return MaskedDepthLoss.apply(gt_imgs, imgs, depth_max, background, gt_mask_only)
+
+class MaskedDepthLoss(torch.autograd.Function):
+    # Autograd would keep the masks, differences and clamps of every view alive
+    # until the backward pass. Only the inputs are saved here, the rest is
+    # recomputed in the backward pass, which needs one image stack at a time.
+
+    @staticmethod
+    def terms(gt_imgs, imgs, depth_max, background, gt_mask_only):
+        gt_imgs = gt_imgs.unsqueeze(1)
+        mask_gt = gt_imgs != background
+        mask_union = (mask_gt | (imgs != background)).float()
+        diff = gt_imgs - imgs
+        if(gt_mask_only):
+            num_pixels = torch.sum(mask_gt, dim=(2,3)).float()
+        else:
+            num_pixels = torch.sum(mask_union, dim=(2,3))
+        return diff, mask_union, num_pixels
+
+    @staticmethod
+    def forward(ctx, gt_imgs, imgs, depth_max, background, gt_mask_only):
+        ctx.save_for_backward(gt_imgs, imgs)
+        ctx.options = (depth_max, background, gt_mask_only)
+        diff, mask_union, num_pixels = MaskedDepthLoss.terms(gt_imgs, imgs, depth_max, background, gt_mask_only)
+        diff = torch.clamp(torch.abs(diff), 0.0, depth_max)/depth_max
+        return torch.sum(diff*mask_union, dim=(2,3))/num_pixels
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        gt_imgs, imgs = ctx.saved_tensors
+        depth_max, background, gt_mask_only = ctx.options
+        diff, mask_union, num_pixels = MaskedDepthLoss.terms(gt_imgs, imgs, depth_max, background, gt_mask_only)
+
+        # d|gt - img|/d gt inside of the clamp range, the masks are constant
+        grad_diff = torch.sign(diff)*(torch.abs(diff) <= depth_max).float()*mask_union
+        grad_diff *= (grad_output/(num_pixels*depth_max)).unsqueeze(-1).unsqueeze(-1)
+
+        grad_gt = grad_imgs = None
+        if(ctx.needs_input_grad[0]):
+            grad_gt = torch.sum(grad_diff, dim=1)
+        if(ctx.needs_input_grad[1]):
+            grad_imgs = -grad_diff
+        return grad_gt, grad_imgs, None, None, None
+
+def viewDepthLosses(renderer, gt_imgs, Rs_predicted, confs, ts, ids, config,
+                    background=-1, gt_mask_only=False):
+    # Depth losses (B,V) and renders (B,V,H,W,...) of the predicted views
+    #
+    # With [Loss_parameters] RENDER_TOP_K only the k most confident views of each
+    # sample (and RENDER_EXPLORE random other views) are rendered while training.
+    # The loss of a view that is not rendered is bounded by the loss of a rendered
+    # view plus their geodesic distance, the surrogate is the tightest such bound:
+    #   min_r loss_r + RENDER_SURROGATE_SCALE*angle(view, r)/pi
+    # with the rendered losses detached, so the gradient moves the view towards
+    # the rendered view with the lowest bound. The views are always all rendered
+    # without gradients (validation), so the validation loss stays exact.
+    depth_max = config.getfloat('Loss_parameters', 'DEPTH_MAX', fallback=30.0)
+    max_batch = config.getint('Rendering', 'MAX_RENDER_BATCH', fallback=0)
+    top_k = config.getint('Loss_parameters', 'RENDER_TOP_K', fallback=0)
+    explore = config.getint('Loss_parameters', 'RENDER_EXPLORE', fallback=0)
+    surrogate_scale = config.getfloat('Loss_parameters', 'RENDER_SURROGATE_SCALE', fallback=1.0)
+    batch_size, num_views = Rs_predicted.shape[:2]
+
+    if(top_k <= 0 or top_k + explore >= num_views or not torch.is_grad_enabled()):
+        with timer.phase("predicted_render"):
+            predicted_imgs = renderViews(renderer, Rs_predicted, ts, ids, max_batch)
+        losses = maskedDepthLoss(gt_imgs, predicted_imgs, depth_max,
+                                 background=background, gt_mask_only=gt_mask_only)
+        return losses, predicted_imgs
+
+    # Select the views to render
+    confs = confs.detach()
+    indices = torch.topk(confs, top_k, dim=1)[1]
+    if(explore > 0):
+        noise = torch.rand(confs.shape, device=confs.device)
+        noise = noise.scatter(1, indices, -1.0)
+        indices = torch.cat([indices, torch.topk(noise, explore, dim=1)[1]], dim=1)
+    batch_indices = torch.arange(batch_size, device=indices.device).unsqueeze(1).expand_as(indices)
+    Rs_rendered = Rs_predicted[batch_indices, indices]
+
+    with timer.phase("predicted_render"):
+        rendered_imgs = renderViews(renderer, Rs_rendered, ts, ids, max_batch)
+    rendered_losses = maskedDepthLoss(gt_imgs, rendered_imgs, depth_max,
+                                      background=background, gt_mask_only=gt_mask_only)
+
+    # Surrogate for every view, replaced by the real loss for the rendered ones.
+    # The rendered views are detached so that they are not pulled towards the others.
+    theta = compute_geodesic_distance(Rs_predicted.unsqueeze(2), Rs_rendered.detach().unsqueeze(1), epsilon=1e-5) # B,V,k
+    bounds = rendered_losses.detach().unsqueeze(1) + surrogate_scale*theta/np.pi
+    losses = torch.min(bounds, dim=2)[0]
+    losses = losses.scatter(1, indices, rendered_losses)
+
+    # The views that are not rendered are shown as background
+    predicted_imgs = torch.full((batch_size, num_views) + rendered_imgs.shape[2:], float(background),
+                                device=rendered_imgs.device, dtype=rendered_imgs.dtype)
+    predicted_imgs[batch_indices, indices] = rendered_imgs.detach()
+    return losses, predicted_imgs
+
+def pointDepthLoss(renderer, Rs_gt, Rs_predicted, ids, depth_max):
+    # Render-free approximation of the masked depth loss (B,V)
+    #
+    # The visible surface points of the object (see BatchRender.initPoints) are
+    # rotated by the GT and predicted rotations. Each visible point is compared to
+    # the closest visible point of the other pose, so that poses which look the
+    # same (symmetries) have no loss. As for the depth images the distances are
+    # clamped to depth_max and averaged over the visible points of both poses.
+    batch_size, num_views = Rs_predicted.shape[:2]
+    points, mask_gt = renderer.visiblePoints(Rs_gt, ids)
+    points_gt = torch.matmul(points, Rs_gt) # Row vectors as in Pytorch3D, B,N,3
+    far = 10.0*depth_max # Masks the invisible points, finite to keep the gradients finite
+
+    losses = []
+    for i in range(num_views):
+        _, mask_pd = renderer.visiblePoints(Rs_predicted[:,i], ids)
+        points_pd = torch.matmul(points, Rs_predicted[:,i])
+        dists = torch.cdist(points_pd, points_gt) # B,N_pd,N_gt
+        dist_pd = torch.min(dists + far*(~mask_gt).unsqueeze(1).float(), dim=2)[0]
+        dist_gt = torch.min(dists + far*(~mask_pd).unsqueeze(2).float(), dim=1)[0]
+        dist_pd = torch.clamp(dist_pd, 0.0, depth_max)/depth_max
+        dist_gt = torch.clamp(dist_gt, 0.0, depth_max)/depth_max
+        view_loss = (torch.sum(dist_pd*mask_pd, dim=1) + torch.sum(dist_gt*mask_gt, dim=1)) / \
+                    (torch.sum(mask_pd, dim=1) + torch.sum(mask_gt, dim=1)).float().clamp(min=1.0)
+        losses.append(view_loss.unsqueeze(-1))
+    return torch.cat(losses, dim=1)
+
+def pairwisePoseLoss(Rs_predicted, pose_max):
+    # Penalizes views closer than pose_max degrees, one column per pair (k,i) with k < i
+    num_views = Rs_predicted.shape[1]
+    if(num_views == 1):
+        return torch.zeros((Rs_predicted.shape[0], 1), device=Rs_predicted.device)
+
+    # Angles between all pairs of views (B,V,V) from one batched matmul
+    theta = compute_pairwise_geodesic_distance(Rs_predicted, epsilon=1e-5)
+    degree = theta * (180.0/3.14159)
+    pose_diff = 1.0 - (torch.clamp(degree, 0.0, pose_max)/pose_max)
+
+    # Pairs (k,i) ordered by i, then k
+    i_indices, k_indices = np.tril_indices(num_views, k=-1)
+    return pose_diff[:, k_indices, i_indices]
+
 def Loss(predicted_poses,
          gt_poses,
          renderer,
@@ -19,14 +208,19 @@ def Loss(predicted_poses,
          ids=[],
          views=None,
          config=None,
-         fixed_gt_images=None):
+         fixed_gt_images=None,
+         cached_gt_images=None,
+         gt_cache=None):
     Rs_gt = torch.tensor(np.stack(gt_poses), device=renderer.device,
                             dtype=torch.float32)
+    # The rendering and the depth comparisons are always done in fp32
+    predicted_poses = predicted_poses.float()
     if config is None:
         config = configparser.ConfigParser()
 
     loss_method = config.get('Training', 'LOSS', fallback='vsd-union')
     pose_rep = config.get('Training', 'POSE_REPRESENTATION', fallback='6d-pose')
+    max_batch = config.getint('Rendering', 'MAX_RENDER_BATCH', fallback=0)
 
     pose_rep_func = None
     if fixed_gt_images is None:
@@ -54,170 +248,68 @@ def Loss(predicted_poses,
         pose_max = config.getfloat('Loss_parameters', 'POSE_MAX', fallback=40.0)
         num_views = len(views)
         gamma = config.getfloat('Loss_parameters', 'GAMMA', fallback=1.0 / num_views)
-        pose_start = num_views
-        pose_end = pose_start + 6
 
         # Prepare gt images
-        gt_images = []
-        predicted_images = []
-        gt_imgs = renderer.renderBatch(Rs_gt, ts, ids)
+        if cached_gt_images is None:
+            with timer.phase("gt_render"):
+                gt_imgs = renderGroundTruth(renderer, Rs_gt, ts, ids, gt_cache)
+        else: # Precomputed GT renders, see DatasetHeadOnly.py
+            gt_imgs = cached_gt_images
 
-        losses = []
         confs = predicted_poses[:,:num_views]
-        prev_poses = []
-        pose_losses = []
-        for i,v in enumerate(views):
-            # Extract current pose and move to next one
-            if fixed_gt_images is None:
-                curr_pose = predicted_poses[:,pose_start:pose_end]
-                Rs_predicted = pose_rep_func(curr_pose)
-            else:
-                pose_matrix = predicted_poses[:,1:].reshape(1,3,3)
-                Rs_predicted = pose_matrix
-            pose_start = pose_end
-            pose_end = pose_start + 6
-
-            # Render predicted images
-            imgs = renderer.renderBatch(Rs_predicted, ts, ids)
-            predicted_images.append(imgs)
-            gt_images.append(gt_imgs)
-
-            # # Visiblity mask
-            # mask_gt = gt_imgs != 0
-            # mask_pd = imgs != 0
-            # mask_union = torch.zeros_like(gt_imgs)
-            # mask_union[mask_gt] = 1.0
-            # mask_union[mask_pd] = 1.0
-
-            # # Calculate loss
-            # diff = torch.abs(gt_imgs - imgs)
-            # diff = torch.clamp(diff, 0.0, depth_max)/depth_max
-            # batch_loss = torch.sum(diff*mask_union, dim=(1,2))/torch.sum(mask_union, dim=(1,2))
-
-            # batch_loss = (batch_loss*confs[:,i] + gamma*batch_loss)/2.0
-            # losses.append(batch_loss.unsqueeze(-1))
-
-            # # Calculate pose loss
-            # for k,p in enumerate(prev_poses):
-            #     R = torch.matmul(p, torch.transpose(Rs_predicted, 1, 2))
-            #     R_trace = torch.diagonal(R, dim1=-2, dim2=-1).sum(-1)
-            #     theta = (R_trace - 1.0)/2.0
-            #     epsilon=1e-5
-            #     theta = torch.acos(torch.clamp(theta, -1 + epsilon, 1 - epsilon))
-            #     degree = theta * (180.0/3.14159)
-
-            #     pose_diff = 1.0 - (torch.clamp(degree, 0.0, pose_max)/pose_max)
-
-            #     pose_batch_loss = pose_diff
-            #     pose_losses.append(pose_batch_loss.unsqueeze(-1))
-
-            # # Add current predicted poses to list of previous ones
-            # prev_poses.append(Rs_predicted)
-
-            # Batch pose loss
-            batch_loss = nn.MSELoss(reduction='none')(Rs_predicted, Rs_gt)
-            batch_loss = torch.sum(batch_loss, dim=(1,2)).unsqueeze(-1)
-            #print(batch_loss)
-            losses.append(batch_loss)
-
+        Rs_predicted = predictedRotations(predicted_poses, num_views, num_views,
+                                          pose_rep_func, fixed_gt_images)
 
+        # Render predicted images
+        with timer.phase("predicted_render"):
+            predicted_imgs = renderViews(renderer, Rs_predicted, ts, ids, max_batch)
 
-        # Concat different views
-        gt_imgs = torch.cat(gt_images, dim=1)
-        predicted_imgs = torch.cat(predicted_images, dim=1)
-        losses = torch.cat(losses, dim=1)
-        if(num_views == 1):
-            pose_losses = torch.zeros_like(losses)
-        else:
-            pose_losses = torch.cat(pose_losses, dim=1)
-        #pose_losses = torch.mean(pose_losses, dim=1)
+        # Batch pose loss
+        losses = torch.sum((Rs_predicted - Rs_gt.unsqueeze(1))**2, dim=(2,3))
         depth_losses = torch.sum(losses, dim=1)
 
         dbg("depth loss {}".format(torch.mean(depth_losses)), dbg_losses)
-        #dbg("pose loss  {}".format(torch.mean(pose_losses)), dbg_losses)
 
-        batch_loss = depth_losses# + pose_losses
+        # Concat different views
+        gt_imgs = stackViews(gt_imgs.unsqueeze(1).expand((-1, num_views) + gt_imgs.shape[1:]))
+        predicted_imgs = stackViews(predicted_imgs)
+
+        batch_loss = depth_losses
         batch_loss = batch_loss.unsqueeze(-1)
         loss = torch.mean(batch_loss)
         return loss, batch_loss, gt_imgs, predicted_imgs
 
-
-    # Old buggy version
-    if(loss_method=="vsd-union-old"):
+    # vsd-union-old is the old buggy version (background of 0 instead of -1),
+    # vsd-gt-mask normalizes the depth differences by the GT mask only
+    if(loss_method in ["vsd-union-old", "vsd-union", "vsd-gt-mask"]):
         depth_max = config.getfloat('Loss_parameters', 'DEPTH_MAX', fallback=30.0)
         pose_max = config.getfloat('Loss_parameters', 'POSE_MAX', fallback=40.0)
         num_views = len(views)
         gamma = config.getfloat('Loss_parameters', 'GAMMA', fallback=1.0 / num_views)
-        pose_start = num_views
-        pose_end = pose_start + 6
 
         # Prepare gt images
-        gt_images = []
-        predicted_images = []
-        gt_imgs = renderer.renderBatch(Rs_gt, ts, ids)
+        if cached_gt_images is None:
+            with timer.phase("gt_render"):
+                gt_imgs = renderGroundTruth(renderer, Rs_gt, ts, ids, gt_cache)
+        else: # Precomputed GT renders, see DatasetHeadOnly.py
+            gt_imgs = cached_gt_images
 
-        losses = []
         confs = predicted_poses[:,:num_views]
-        prev_poses = []
-        pose_losses = []
-        for i,v in enumerate(views):
-            # Extract current pose and move to next one
-            if fixed_gt_images is None:
-                curr_pose = predicted_poses[:,pose_start:pose_end]
-                Rs_predicted = pose_rep_func(curr_pose)
-            else:
-                pose_matrix = predicted_poses[:,1:].reshape(1,3,3)
-                Rs_predicted = pose_matrix
-            pose_start = pose_end
-            pose_end = pose_start + 6
-
-            # Render predicted images
-            imgs = renderer.renderBatch(Rs_predicted, ts, ids)
-            predicted_images.append(imgs)
-            gt_images.append(gt_imgs)
-
-            # Visiblity mask
-            mask_gt = gt_imgs != 0
-            mask_pd = imgs != 0
-            mask_union = torch.zeros_like(gt_imgs)
-            mask_union[mask_gt] = 1.0
-            mask_union[mask_pd] = 1.0
-
-            # Calculate loss
-            diff = torch.abs(gt_imgs - imgs)
-            diff = torch.clamp(diff, 0.0, depth_max)/depth_max
-            batch_loss = torch.sum(diff*mask_union, dim=(1,2))/torch.sum(mask_union, dim=(1,2))
-
-            batch_loss = (batch_loss*confs[:,i] + gamma*batch_loss)/2.0
-            losses.append(batch_loss.unsqueeze(-1))
-
-            # Calculate pose loss
-            for k,p in enumerate(prev_poses):
-                R = torch.matmul(p, torch.transpose(Rs_predicted, 1, 2))
-                R_trace = torch.diagonal(R, dim1=-2, dim2=-1).sum(-1)
-                theta = (R_trace - 1.0)/2.0
-                epsilon=1e-5
-                theta = torch.acos(torch.clamp(theta, -1 + epsilon, 1 - epsilon))
-                degree = theta * (180.0/3.14159)
-
-                pose_diff = 1.0 - (torch.clamp(degree, 0.0, pose_max)/pose_max)
-
-                pose_batch_loss = pose_diff
-                pose_losses.append(pose_batch_loss.unsqueeze(-1))
-
-            # Add current predicted poses to list of previous ones
-            prev_poses.append(Rs_predicted)
+        Rs_predicted = predictedRotations(predicted_poses, num_views, num_views,
+                                          pose_rep_func, fixed_gt_images)
 
+        # Render predicted images and calculate the loss of all views at once
+        losses, predicted_imgs = viewDepthLosses(renderer, gt_imgs, Rs_predicted, confs, ts, ids, config,
+                                                 background=0 if loss_method == "vsd-union-old" else -1,
+                                                 gt_mask_only=loss_method == "vsd-gt-mask")
+        losses = (losses*confs + gamma*losses)/2.0
 
+        # Calculate pose loss
+        pose_losses = pairwisePoseLoss(Rs_predicted, pose_max)
 
         # Concat different views
-        gt_imgs = torch.cat(gt_images, dim=1)
-        predicted_imgs = torch.cat(predicted_images, dim=1)
-        losses = torch.cat(losses, dim=1)
-        if(num_views == 1):
-            pose_losses = torch.zeros_like(losses)
-        else:
-            pose_losses = torch.cat(pose_losses, dim=1)
+        gt_imgs = stackViews(gt_imgs.unsqueeze(1).expand((-1, num_views) + gt_imgs.shape[1:]))
+        predicted_imgs = stackViews(predicted_imgs)
         pose_losses = torch.mean(pose_losses, dim=1)
         depth_losses = torch.sum(losses, dim=1)
 
@@ -229,91 +321,37 @@ def Loss(predicted_poses,
         loss = torch.mean(batch_loss)
         return loss, batch_loss, gt_imgs, predicted_imgs
 
-    if(loss_method=="vsd-union"):
+    # Approximates vsd-union on surface points, without rendering
+    if(loss_method=="point-vsd"):
         depth_max = config.getfloat('Loss_parameters', 'DEPTH_MAX', fallback=30.0)
         pose_max = config.getfloat('Loss_parameters', 'POSE_MAX', fallback=40.0)
         num_views = len(views)
         gamma = config.getfloat('Loss_parameters', 'GAMMA', fallback=1.0 / num_views)
-        pose_start = num_views
-        pose_end = pose_start + 6
-
-        # Prepare gt images
-        gt_images = []
-        predicted_images = []
-        gt_imgs = renderer.renderBatch(Rs_gt, ts, ids)
+        if(renderer.points is None):
+            renderer.initPoints(num_points=config.getint('Loss_parameters', 'POINT_SAMPLES', fallback=256),
+                                num_directions=config.getint('Loss_parameters', 'POINT_VIEW_DIRECTIONS', fallback=1000))
 
-        losses = []
         confs = predicted_poses[:,:num_views]
-        prev_poses = []
-        pose_losses = []
-        for i,v in enumerate(views):
-            # Extract current pose and move to next one
-            if fixed_gt_images is None:
-                curr_pose = predicted_poses[:,pose_start:pose_end]
-                Rs_predicted = pose_rep_func(curr_pose)
-            else:
-                pose_matrix = predicted_poses[:,1:].reshape(1,3,3)
-                Rs_predicted = pose_matrix
-            pose_start = pose_end
-            pose_end = pose_start + 6
-
-            # Render predicted images
-            imgs = renderer.renderBatch(Rs_predicted, ts, ids)
-            predicted_images.append(imgs)
-            gt_images.append(gt_imgs)
-
-            # Visiblity mask
-            mask_gt = gt_imgs != -1
-            mask_pd = imgs != -1
-            mask_union = torch.zeros_like(gt_imgs)
-            mask_union[mask_gt] = 1.0
-            mask_union[mask_pd] = 1.0
-
-            # Calculate loss
-            diff = torch.abs(gt_imgs - imgs)
-            diff = torch.clamp(diff, 0.0, depth_max)/depth_max
-            batch_loss = torch.sum(diff*mask_union, dim=(1,2))/torch.sum(mask_union, dim=(1,2))
-
-            batch_loss = (batch_loss*confs[:,i] + gamma*batch_loss)/2.0
-            losses.append(batch_loss.unsqueeze(-1))
-
-            # Calculate pose loss
-            for k,p in enumerate(prev_poses):
-                R = torch.matmul(p, torch.transpose(Rs_predicted, 1, 2))
-                R_trace = torch.diagonal(R, dim1=-2, dim2=-1).sum(-1)
-                theta = (R_trace - 1.0)/2.0
-                epsilon=1e-5
-                theta = torch.acos(torch.clamp(theta, -1 + epsilon, 1 - epsilon))
-                degree = theta * (180.0/3.14159)
-
-                pose_diff = 1.0 - (torch.clamp(degree, 0.0, pose_max)/pose_max)
-
-                pose_batch_loss = pose_diff
-                pose_losses.append(pose_batch_loss.unsqueeze(-1))
-
-            # Add current predicted poses to list of previous ones
-            prev_poses.append(Rs_predicted)
+        Rs_predicted = predictedRotations(predicted_poses, num_views, num_views,
+                                          pose_rep_func, fixed_gt_images)
 
+        with timer.phase("point_loss"):
+            losses = pointDepthLoss(renderer, Rs_gt, Rs_predicted, ids, depth_max)
+        losses = (losses*confs + gamma*losses)/2.0
 
-
-        # Concat different views
-        gt_imgs = torch.cat(gt_images, dim=1)
-        predicted_imgs = torch.cat(predicted_images, dim=1)
-        losses = torch.cat(losses, dim=1)
-        if(num_views == 1):
-            pose_losses = torch.zeros_like(losses)
-        else:
-            pose_losses = torch.cat(pose_losses, dim=1)
+        # Calculate pose loss
+        pose_losses = pairwisePoseLoss(Rs_predicted, pose_max)
         pose_losses = torch.mean(pose_losses, dim=1)
         depth_losses = torch.sum(losses, dim=1)
 
         dbg("depth loss {}".format(torch.mean(depth_losses)), dbg_losses)
         dbg("pose loss  {}".format(torch.mean(pose_losses)), dbg_losses)
 
+        # Nothing is rendered, so there are no images to show
         batch_loss = depth_losses + pose_losses
         batch_loss = batch_loss.unsqueeze(-1)
         loss = torch.mean(batch_loss)
-        return loss, batch_loss, gt_imgs, predicted_imgs
+        return loss, batch_loss, None, None
 
     if(loss_method=="vsd-union-multi-object"):
         depth_max = config.getfloat('Loss_parameters', 'DEPTH_MAX', fallback=30.0)
@@ -323,13 +361,13 @@ def Loss(predicted_poses,
         gamma = config.getfloat('Loss_parameters', 'GAMMA', fallback=1.0 / num_views)
         class_weight = config.getfloat('Loss_parameters', 'CLASSIFY_WEIGHT', fallback=1.0)
         classify_objects=config.getboolean('Training','CLASSIFY_OBJECTS', fallback=False)
-        pose_start = 0
-        pose_end = pose_start + 6
 
         # Prepare gt images
-        gt_images = []
-        predicted_images = []
-        gt_imgs = renderer.renderBatch(Rs_gt, ts, ids)
+        if cached_gt_images is None:
+            with timer.phase("gt_render"):
+                gt_imgs = renderGroundTruth(renderer, Rs_gt, ts, ids, gt_cache)
+        else: # Precomputed GT renders, see DatasetHeadOnly.py
+            gt_imgs = cached_gt_images
 
         # Seperate classes and pose predictions if classifying objects
         if(classify_objects):
@@ -349,65 +387,19 @@ def Loss(predicted_poses,
             poses = poses.reshape(-1,num_objects,num_views*6)
             poses = poses[torch.arange(poses.size(0)), idx_mask].squeeze(1)
 
-        losses = []
-        prev_poses = []
-        pose_losses = []
-        for i,v in enumerate(views):
-            # Extract current pose and move to next one
-            if fixed_gt_images is None:
-                curr_pose = poses[:,pose_start:pose_end]
-                Rs_predicted = pose_rep_func(curr_pose)
-            else:
-                pose_matrix = poses[:,1:].reshape(1,3,3)
-                Rs_predicted = pose_matrix
-            pose_start = pose_end
-            pose_end = pose_start + 6
-
-            # Render predicted images
-            imgs = renderer.renderBatch(Rs_predicted, ts, ids)
-            predicted_images.append(imgs)
-            gt_images.append(gt_imgs)
-
-            # Visiblity mask
-            mask_gt = gt_imgs != -1
-            mask_pd = imgs != -1
-            mask_union = torch.zeros_like(gt_imgs)
-            mask_union[mask_gt] = 1.0
-            mask_union[mask_pd] = 1.0
-
-            # Calculate loss
-            diff = torch.abs(gt_imgs - imgs)
-            diff = torch.clamp(diff, 0.0, depth_max)/depth_max
-            batch_loss = torch.sum(diff*mask_union, dim=(1,2))/torch.sum(mask_union, dim=(1,2))
-
-            batch_loss = (batch_loss*confs[:,i] + gamma*batch_loss)/2.0
-            losses.append(batch_loss.unsqueeze(-1))
-
-            # Calculate pose loss
-            for k,p in enumerate(prev_poses):
-                R = torch.matmul(p, torch.transpose(Rs_predicted, 1, 2))
-                R_trace = torch.diagonal(R, dim1=-2, dim2=-1).sum(-1)
-                theta = (R_trace - 1.0)/2.0
-                epsilon=1e-5
-                theta = torch.acos(torch.clamp(theta, -1 + epsilon, 1 - epsilon))
-                degree = theta * (180.0/3.14159)
-
-                pose_diff = 1.0 - (torch.clamp(degree, 0.0, pose_max)/pose_max)
-
-                pose_batch_loss = pose_diff
-                pose_losses.append(pose_batch_loss.unsqueeze(-1))
-
-            # Add current predicted poses to list of previous ones
-            prev_poses.append(Rs_predicted)
+        Rs_predicted = predictedRotations(poses, 0, num_views,
+                                          pose_rep_func, fixed_gt_images)
+
+        # Render predicted images and calculate the loss of all views at once
+        losses, predicted_imgs = viewDepthLosses(renderer, gt_imgs, Rs_predicted, confs, ts, ids, config)
+        losses = (losses*confs + gamma*losses)/2.0
+
+        # Calculate pose loss
+        pose_losses = pairwisePoseLoss(Rs_predicted, pose_max)
 
         # Concat different views
-        gt_imgs = torch.cat(gt_images, dim=1)
-        predicted_imgs = torch.cat(predicted_images, dim=1)
-        losses = torch.cat(losses, dim=1)
-        if(num_views == 1):
-            pose_losses = torch.zeros_like(losses)
-        else:
-            pose_losses = torch.cat(pose_losses, dim=1)
+        gt_imgs = stackViews(gt_imgs.unsqueeze(1).expand((-1, num_views) + gt_imgs.shape[1:]))
+        predicted_imgs = stackViews(predicted_imgs)
         pose_losses = torch.mean(pose_losses, dim=1)
         depth_losses = torch.sum(losses, dim=1)
 
@@ -431,92 +423,5 @@ def Loss(predicted_poses,
         loss = torch.mean(batch_loss)
         return loss, batch_loss, gt_imgs, predicted_imgs
 
-
-    if(loss_method=="vsd-gt-mask"):
-        depth_max = config.getfloat('Loss_parameters', 'DEPTH_MAX', fallback=30.0)
-        pose_max = config.getfloat('Loss_parameters', 'POSE_MAX', fallback=40.0)
-        num_views = len(views)
-        gamma = config.getfloat('Loss_parameters', 'GAMMA', fallback=1.0 / num_views)
-        pose_start = num_views
-        pose_end = pose_start + 6
-
-        # Prepare gt images
-        gt_images = []
-        predicted_images = []
-        gt_imgs = renderer.renderBatch(Rs_gt, ts, ids)
-
-        losses = []
-        confs = predicted_poses[:,:num_views]
-        prev_poses = []
-        pose_losses = []
-        for i,v in enumerate(views):
-            # Extract current pose and move to next one
-            if fixed_gt_images is None:
-                curr_pose = predicted_poses[:,pose_start:pose_end]
-                Rs_predicted = pose_rep_func(curr_pose)
-            else:
-                pose_matrix = predicted_poses[:,1:].reshape(1,3,3)
-                Rs_predicted = pose_matrix
-            pose_start = pose_end
-            pose_end = pose_start + 6
-
-            # Render predicted images
-            imgs = renderer.renderBatch(Rs_predicted, ts, ids)
-            predicted_images.append(imgs)
-            gt_images.append(gt_imgs)
-
-            # Visiblity mask
-            mask_gt = gt_imgs != -1
-            mask_pd = imgs != -1
-            mask_union = torch.zeros_like(gt_imgs)
-            mask_union[mask_gt] = 1.0
-            mask_union[mask_pd] = 1.0
-
-            # Calculate loss
-            diff = torch.abs(gt_imgs - imgs)
-            diff = torch.clamp(diff, 0.0, depth_max)/depth_max
-            batch_loss = torch.sum(diff*mask_union, dim=(1,2))/torch.sum(mask_gt, dim=(1,2))
-
-            batch_loss = (batch_loss*confs[:,i] + gamma*batch_loss)/2.0
-            losses.append(batch_loss.unsqueeze(-1))
-
-            # Calculate pose loss
-            for k,p in enumerate(prev_poses):
-                R = torch.matmul(p, torch.transpose(Rs_predicted, 1, 2))
-                R_trace = torch.diagonal(R, dim1=-2, dim2=-1).sum(-1)
-                theta = (R_trace - 1.0)/2.0
-                epsilon=1e-5
-                theta = torch.acos(torch.clamp(theta, -1 + epsilon, 1 - epsilon))
-                degree = theta * (180.0/3.14159)
-
-                pose_diff = 1.0 - (torch.clamp(degree, 0.0, pose_max)/pose_max)
-
-                pose_batch_loss = pose_diff
-                pose_losses.append(pose_batch_loss.unsqueeze(-1))
-
-            # Add current predicted poses to list of previous ones
-            prev_poses.append(Rs_predicted)
-
-
-
-        # Concat different views
-        gt_imgs = torch.cat(gt_images, dim=1)
-        predicted_imgs = torch.cat(predicted_images, dim=1)
-        losses = torch.cat(losses, dim=1)
-        if(num_views == 1):
-            pose_losses = torch.zeros_like(losses)
-        else:
-            pose_losses = torch.cat(pose_losses, dim=1)
-        pose_losses = torch.mean(pose_losses, dim=1)
-        depth_losses = torch.sum(losses, dim=1)
-
-        dbg("depth loss {}".format(torch.mean(depth_losses)), dbg_losses)
-        dbg("pose loss  {}".format(torch.mean(pose_losses)), dbg_losses)
-
-        batch_loss = depth_losses + pose_losses
-        batch_loss = batch_loss.unsqueeze(-1)
-        loss = torch.mean(batch_loss)
-        return loss, batch_loss, gt_imgs, predicted_imgs
-
     print("Unknown loss specified")
     return -1, None, None, None
@@ -22,6 +22,7 @@ from Pipeline import Pipeline
 from BatchRender import BatchRender
 from losses import Loss
 from DatasetGeneratorOpenGL import DatasetGenerator
+from DatasetHeadOnly import HeadOnlyDataset
 #from DatasetGeneratorSM import DatasetGenerator
 
 optimizer = None
@@ -139,16 +140,24 @@ def main():
         model_path_data = [args.get('Dataset', 'MODEL_PATH_DATA')]
         translations = [np.array(json.loads(args.get('Rendering', 'T')))]
 
-    # Prepare datasets
-    bg_path = "../../autoencoder_ws/data/VOC2012/JPEGImages/"
-    training_data = DatasetGenerator(args.get('Dataset', 'BACKGROUND_IMAGES'),
-                                     model_path_data,
-                                     translations,
-                                     args.getint('Training', 'BATCH_SIZE'),
-                                     "not_used",
-                                     device,
-                                     args.get('Training', 'VIEW_SAMPLING'))
-    training_data.max_samples = args.getint('Training', 'NUM_SAMPLES')
+    # Much faster LR range tests on precomputed codes and GT renders
+    head_only_data = args.get('Training', 'HEAD_ONLY_DATA', fallback=None)
+    if(head_only_data is not None):
+        training_data = HeadOnlyDataset(head_only_data, args.getint('Training', 'BATCH_SIZE'), device)
+        if(training_data.info["image_size"] != br.image_size):
+            raise ValueError("HEAD_ONLY_DATA was rendered at image size {0}, not {1}".format(
+                training_data.info["image_size"], br.image_size))
+    else:
+        # Prepare datasets
+        bg_path = "../../autoencoder_ws/data/VOC2012/JPEGImages/"
+        training_data = DatasetGenerator(args.get('Dataset', 'BACKGROUND_IMAGES'),
+                                         model_path_data,
+                                         translations,
+                                         args.getint('Training', 'BATCH_SIZE'),
+                                         "not_used",
+                                         device,
+                                         args.get('Training', 'VIEW_SAMPLING'))
+        training_data.max_samples = args.getint('Training', 'NUM_SAMPLES')
 
     # Start training
     np.random.seed(seed=args.getint('Training', 'RANDOM_SEED'))
@@ -190,7 +199,10 @@ def runEpoch(br, dataset, model,
         input_images = curr_batch["images"]
 
         # Predict poses
-        predicted_poses = pipeline.process(input_images)
+        if("codes" in curr_batch):
+            predicted_poses = pipeline.predict(curr_batch["codes"])
+        else:
+            predicted_poses = pipeline.process(input_images)
 
         # Prepare ground truth poses for the loss function
         T = np.array(t, dtype=np.float32)
@@ -203,7 +215,8 @@ def runEpoch(br, dataset, model,
                                                              ts,
                                                              ids=ids,
                                                              views=views,
-                                                             config=config)
+                                                             config=config,
+                                                             cached_gt_images=curr_batch.get("gt_images"))
 
         Rs = torch.tensor(np.stack(Rs), device=device, dtype=torch.float32)
 
@@ -215,25 +228,24 @@ def runEpoch(br, dataset, model,
 
         #detach all from gpu
         loss.detach().cpu().numpy()
-        gt_images.detach().cpu().numpy()
-        predicted_images.detach().cpu().numpy()
 
         losses = losses + batch_loss.data.detach().cpu().numpy().tolist()
 
-        batch_img_dir = os.path.join(output_path, "images/epoch{0}".format(epoch))
-        prepareDir(batch_img_dir)
-        gt_img = (gt_images[0]).detach().cpu().numpy()
-        predicted_img = (predicted_images[0]).detach().cpu().numpy()
-
-        vmin = np.linalg.norm(T)*0.9
-        vmax = max(np.max(gt_img), np.max(predicted_img))
-
-        fig = plt.figure(figsize=(12,3+len(views)*2))
-        plotView(0, len(views), vmin, vmax, input_images, gt_images, predicted_images,
-                 predicted_poses, batch_loss, batch_size, threshold=config['Loss_parameters'].getfloat('DEPTH_MAX'))
-        fig.tight_layout()
-        fig.savefig(os.path.join(batch_img_dir, "epoch{0}-batch{1}.png".format(epoch,i)), dpi=fig.dpi)
-        plt.close()
+        if(input_images is not None and gt_images is not None):
+            batch_img_dir = os.path.join(output_path, "images/epoch{0}".format(epoch))
+            prepareDir(batch_img_dir)
+            gt_img = (gt_images[0]).detach().cpu().numpy()
+            predicted_img = (predicted_images[0]).detach().cpu().numpy()
+
+            vmin = np.linalg.norm(T)*0.9
+            vmax = max(np.max(gt_img), np.max(predicted_img))
+
+            fig = plt.figure(figsize=(12,3+len(views)*2))
+            plotView(0, len(views), vmin, vmax, input_images, gt_images, predicted_images,
+                     predicted_poses, batch_loss, batch_size, threshold=config['Loss_parameters'].getfloat('DEPTH_MAX'))
+            fig.tight_layout()
+            fig.savefig(os.path.join(batch_img_dir, "epoch{0}-batch{1}.png".format(epoch,i)), dpi=fig.dpi)
+            plt.close()
 
         lr_reducer.step()
         break
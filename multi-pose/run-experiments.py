@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import resource
+import subprocess
+import configparser
+
+from utils.metrics import MetricsStore
+
+# Runs several experiments of train.py in parallel, one per slot (--devices)
+#
+#   python run-experiments.py exp1.cfg exp2.cfg --devices cuda:0,cuda:1
+#   python run-experiments.py experiment_template.cfg --devices cpu,cpu,cpu \
+#       --grid Training.LEARNING_RATE=0.0001,0.001 --grid Training.BATCH_SIZE=8,16
+#
+# Every job gets its own config in ./experiments/scheduled/ with the DEVICE of
+# its slot (and the grid values, grid jobs also get their own OUTPUT_PATH).
+# The job state is kept in --state so an interrupted schedule can be started
+# again with the same arguments: finished jobs are skipped and unfinished jobs
+# continue from their latest checkpoint, which train.py loads by itself.
+# A failing job does not stop the others.
+
+SCHEDULED_DIR = "./experiments/scheduled"
+
+def resolveConfig(name):
+    # Same lookup as train.py
+    if(name.startswith('./experiments') or os.path.exists(name)):
+        return name
+    return os.path.join("./experiments", name)
+
+def parseGrid(grid_args):
+    # "Section.KEY=v1,v2" -> [("Section", "KEY", ["v1", "v2"])]
+    grid = []
+    for g in grid_args:
+        key, values = g.split("=", 1)
+        section, option = key.split(".", 1)
+        grid.append((section, option, values.split(",")))
+    return grid
+
+def configKey(config, section, option):
+    # The keys keep their case (optionxform), match the grid keys case-insensitively
+    # so that e.g. training.learning_rate overrides LEARNING_RATE. Options which are
+    # not in the config yet are added in upper case like all keys of the configs.
+    sections = {s.lower(): s for s in config.sections()}
+    if(section.lower() not in sections):
+        raise ValueError("Unknown section in --grid: {0} (sections: {1})".format(section, config.sections()))
+    section = sections[section.lower()]
+    options = {o.lower(): o for o in config.options(section)}
+    return section, options.get(option.lower(), option.upper())
+
+def createJobs(cfg_names, grid):
+    jobs = []
+    for cfg_name in cfg_names:
+        cfg_path = resolveConfig(cfg_name)
+        base_name = os.path.splitext(os.path.basename(cfg_path))[0]
+        for values in itertools.product(*[g[2] for g in grid]):
+            config = configparser.ConfigParser()
+            config.optionxform = str # Keep the case of the keys
+            if(len(config.read(cfg_path)) == 0):
+                raise IOError("Could not read the experiment config: {0}".format(cfg_path))
+            name = base_name
+            for (section, option, _),value in zip(grid, values):
+                section, option = configKey(config, section, option)
+                config.set(section, option, value)
+                name += "_{0}-{1}".format(option.lower(), value)
+            if(len(grid) > 0):
+                config.set('Training', 'OUTPUT_PATH',
+                           os.path.join(config.get('Training', 'OUTPUT_PATH'), name))
+            jobs.append({"name": name, "config": config})
+    names = [j["name"] for j in jobs]
+    if(len(set(names)) != len(names)):
+        raise ValueError("Experiment names are not unique: {0}".format(names))
+    return jobs
+
+def lastEpoch(output_path):
+    # Last epoch with a logged train loss, -1 if the job never finished an epoch
+    if(not os.path.exists(os.path.join(output_path, "metrics.sqlite")) and
+       not os.path.exists(os.path.join(output_path, "train-loss.csv"))):
+        return -1
+    store = openStore(output_path)
+    series = store.series("train_loss")
+    store.close()
+    return series[-1][0] if len(series) > 0 else -1
+
+def openStore(output_path):
+    store = MetricsStore(os.path.join(output_path, "metrics.sqlite"))
+    if(store.is_empty()):
+        store.import_csvs(output_path)
+    return store
+
+def isFinished(job, state):
+    # Early stopped runs only show up as finished in the state
+    if(state.get("status") == "done"):
+        return True
+    num_iter = job["config"].getint('Training', 'NUM_ITER')
+    return lastEpoch(job["config"].get('Training', 'OUTPUT_PATH')) >= num_iter - 1
+
+def resourceLimits(max_memory, device):
+    def apply():
+        os.setsid() # Own process group, the whole job is killed on timeout
+        # CUDA reserves far more address space than it uses, limit CPU jobs only
+        if(max_memory > 0 and not device.startswith("cuda")):
+            limit = int(max_memory*1024**3)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    return apply
+
+def startJob(job, device, arguments, log_dir):
+    env = dict(os.environ)
+    if(arguments.threads > 0):
+        for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]:
+            env[var] = str(arguments.threads)
+    config = job["config"]
+    if(device.startswith("cuda")):
+        # The job sees only its own GPU as cuda:0
+        env["CUDA_VISIBLE_DEVICES"] = device.split(":")[1] if ":" in device else "0"
+        config.set('Training', 'DEVICE', "cuda:0")
+    else:
+        config.set('Training', 'DEVICE', device)
+
+    if(not os.path.isdir(SCHEDULED_DIR)):
+        os.makedirs(SCHEDULED_DIR)
+    cfg_path = os.path.join(SCHEDULED_DIR, job["name"] + ".cfg")
+    with open(cfg_path, "w") as f:
+        config.write(f)
+
+    log_file = open(os.path.join(log_dir, job["name"] + ".log"), "a")
+    log_file.write("=== {0} on {1} ===\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), device))
+    log_file.flush()
+    process = subprocess.Popen([sys.executable, "train.py", cfg_path],
+                               stdout=log_file, stderr=subprocess.STDOUT, env=env,
+                               preexec_fn=resourceLimits(arguments.max_memory, device))
+    return {"job": job, "device": device, "process": process,
+            "log_file": log_file, "start": time.time()}
+
+def saveState(state, path):
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def summaryRows(jobs, state):
+    rows = []
+    for job in jobs:
+        output_path = job["config"].get('Training', 'OUTPUT_PATH')
+        row = {"name": job["name"], "status": state.get(job["name"], {}).get("status", "pending"),
+               "epochs": 0, "train_loss": None, "val_loss": None, "best_val_loss": None,
+               "wall_time": state.get(job["name"], {}).get("wall_time", 0.0)}
+        if(lastEpoch(output_path) >= 0):
+            store = openStore(output_path)
+            train = store.series("train_loss")
+            val = store.series("val_loss")
+            store.close()
+            row["epochs"] = train[-1][0] + 1
+            row["train_loss"] = train[-1][1]
+            if(len(val) > 0):
+                row["val_loss"] = val[-1][1]
+                row["best_val_loss"] = min([v for _,v in val])
+        rows.append(row)
+    return rows
+
+def printSummary(rows, csv_path):
+    columns = ["name", "status", "epochs", "train_loss", "val_loss", "best_val_loss", "wall_time"]
+    def fmt(value):
+        if(value is None):
+            return "-"
+        if(isinstance(value, float)):
+            return "{0:.6g}".format(value)
+        return str(value)
+    table = [columns] + [[fmt(r[c]) for c in columns] for r in rows]
+    widths = [max([len(t[i]) for t in table]) for i in range(len(columns))]
+    print()
+    for t in table:
+        print("  ".join([v.ljust(w) for v,w in zip(t, widths)]))
+    with open(csv_path, "w") as f:
+        for t in table:
+            f.write(",".join(t) + "\n")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("experiments", nargs='+', help="experiment configs, used as templates with --grid")
+    parser.add_argument("--grid", action='append', default=[],
+                        help="Section.KEY=v1,v2,... runs every combination of the values")
+    parser.add_argument("--devices", default="cuda:0",
+                        help="comma separated devices, one job runs per entry at a time (e.g. cuda:0,cuda:1 or cpu,cpu)")
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads per job, 0 to not limit")
+    parser.add_argument("--max-memory", type=float, default=0, help="address space limit of CPU jobs in GB, 0 to not limit")
+    parser.add_argument("--timeout", type=float, default=0, help="wall time limit per job in hours, 0 to not limit")
+    parser.add_argument("--state", default="./output/schedule", help="directory of the job state, logs and summary")
+    arguments = parser.parse_args()
+
+    jobs = createJobs(arguments.experiments, parseGrid(arguments.grid))
+    log_dir = os.path.join(arguments.state, "logs")
+    if(not os.path.isdir(log_dir)):
+        os.makedirs(log_dir)
+    state_path = os.path.join(arguments.state, "state.json")
+    state = {}
+    if(os.path.exists(state_path)):
+        with open(state_path) as f:
+            state = json.load(f)
+
+    pending = []
+    for job in jobs:
+        job_state = state.setdefault(job["name"], {"status": "pending", "wall_time": 0.0})
+        if(isFinished(job, job_state)):
+            job_state["status"] = "done"
+            print("Skipping finished experiment: {0}".format(job["name"]))
+        else:
+            pending.append(job)
+    saveState(state, state_path)
+
+    free_devices = arguments.devices.split(",")
+    running = []
+    try:
+        while(len(pending) > 0 or len(running) > 0):
+            while(len(pending) > 0 and len(free_devices) > 0):
+                job = pending.pop(0)
+                run = startJob(job, free_devices.pop(0), arguments, log_dir)
+                running.append(run)
+                state[job["name"]]["status"] = "running"
+                saveState(state, state_path)
+                print("Started experiment: {0} on {1}".format(job["name"], run["device"]))
+
+            time.sleep(2.0)
+            for run in list(running):
+                job_state = state[run["job"]["name"]]
+                elapsed = time.time() - run["start"]
+                if(run["process"].poll() is None):
+                    if(arguments.timeout > 0 and elapsed > arguments.timeout*3600):
+                        print("Experiment exceeded the time limit: {0}".format(run["job"]["name"]))
+                        os.killpg(run["process"].pid, 9)
+                        run["process"].wait()
+                        run["timed_out"] = True
+                    else:
+                        continue
+                running.remove(run)
+                run["log_file"].close()
+                free_devices.append(run["device"])
+                job_state["wall_time"] += elapsed
+                job_state["returncode"] = run["process"].returncode
+                if(run.get("timed_out")):
+                    job_state["status"] = "timeout"
+                elif(run["process"].returncode == 0):
+                    job_state["status"] = "done"
+                else:
+                    job_state["status"] = "failed"
+                saveState(state, state_path)
+                print("Experiment {0}: {1} after {2:.0f}s".format(run["job"]["name"], job_state["status"], elapsed))
+    except KeyboardInterrupt:
+        # Started again later the jobs continue from their latest checkpoints
+        for run in running:
+            os.killpg(run["process"].pid, 15)
+            run["process"].wait()
+            run["log_file"].close()
+            job_state = state[run["job"]["name"]]
+            job_state["wall_time"] += time.time() - run["start"]
+            job_state["status"] = "interrupted"
+        saveState(state, state_path)
+
+    printSummary(summaryRows(jobs, state), os.path.join(arguments.state, "summary.csv"))
+
+if __name__ == '__main__':
+    main()
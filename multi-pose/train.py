@@ -2,7 +2,6 @@ import os
 import shutil
 import torch
 import numpy as np
-import pickle
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
@@ -12,9 +11,15 @@ import argparse
 import glob
 import gc
 import re
+import contextlib
+import time
+import torch.multiprocessing as mp
 
 from utils.utils import *
 from utils.onecyclelr import OneCycleLR
+from utils.timing import timer as phase_timer, appendJson
+from utils.memory import MemoryTracker
+from utils.metrics import MetricsStore, RunningMean, LossPlotter
 
 from Model import Model
 from Encoder import Encoder
@@ -22,6 +27,11 @@ from Pipeline import Pipeline
 from BatchRender import BatchRender
 from losses import Loss
 from DatasetGeneratorOpenGL import DatasetGenerator
+from CheckpointWriter import CheckpointWriter
+from DatasetValidation import ValidationSet, isCompactDataset
+from DatasetHeadOnly import HeadOnlyDataset
+from ImageWriter import ImageWriter
+from GTRenderCache import GTRenderCache
 #from DatasetGeneratorSM import DatasetGenerator
 
 import imgaug as ia
@@ -29,11 +39,21 @@ import random
 
 optimizer = None
 lr_reducer = None
+grad_scaler = None
+checkpoint_writer = None
+step_writer = None
+image_writer = None
+profiler = None
+metrics = None
+gt_cache = None
 pipeline = None
 views = []
 epoch = 0
 
-dbg_memory = False
+# Distributed training, see setupDistributed()
+rank = 0
+world_size = 1
+dist_device = torch.device("cpu")
 
 def dbg(message, flag):
     if flag:
@@ -53,75 +73,64 @@ def latestCheckpoint(model_dir):
         return checkpoints_sorted[-1]
     return None
 
-def loadDataset(file_list, batch_size=2, obj_id=0):
-    #data = {"codes":[],"Rs":[],"images":[]}
-    data = []
-    for f in file_list:
-        print("Loading dataset: {0}".format(f))
-        with open(f, "rb") as f:
-            curr_data = pickle.load(f, encoding="latin1")
-            curr_batch = {"Rs":[],"images":[], "ids":[]}
-            for i in range(len(curr_data["Rs"])):
-                curr_pose = curr_data["Rs"][i]
-
-                # Convert from T-LESS to Pytorch3D format
-                xy_flip = np.eye(3, dtype=np.float)
-                xy_flip[0,0] = -1.0
-                xy_flip[1,1] = -1.0
-                curr_pose = np.transpose(curr_pose)
-                curr_pose = np.dot(curr_pose, xy_flip)
-                curr_batch["Rs"].append(curr_pose)
-
-                # Normalize image
-                curr_image = curr_data["images"][i]
-                curr_image = curr_image/np.max(curr_image)
-                curr_batch["images"].append(curr_image)
-
-                # Temp fix for loading pickle without ids
-                curr_batch["ids"].append(obj_id)
-
-                if(len(curr_batch["Rs"]) >= batch_size):
-                    data.append(curr_batch)
-                    curr_batch = {"Rs":[],"images":[],"ids":[]}
-            data.append(curr_batch)
-    return data
-
-def main():
-    global optimizer, lr_reducer, views, epoch, pipeline
-    # Read configuration file
-    parser = argparse.ArgumentParser()
-    parser.add_argument("experiment_name")
-    arguments = parser.parse_args()
-
-    if(arguments.experiment_name.startswith('./experiments')):
-        cfg_file_path = arguments.experiment_name
-    else:
-        cfg_file_path = os.path.join("./experiments", arguments.experiment_name)
-    args = configparser.ConfigParser()
-    args.read(cfg_file_path)
-
-    # Set random seed
-    seed=args.getint('Training', 'RANDOM_SEED')
-    if(seed is not None):
-        torch.manual_seed(seed)
-        #torch.use_deterministic_algorithms(True) # Requires pytorch>=1.8.0
-        #torch.backends.cudnn.deterministic = True
-        np.random.seed(seed=seed)
-        ia.seed(seed)
-        random.seed(seed)
-
-    model_seed=args.getint('Training', 'MODEL_RANDOM_SEED', fallback=None)
-    if(model_seed is not None):
-        torch.manual_seed(model_seed)
-
-    # Prepare rotation matrices for multi view loss function
-    eulerViews = json.loads(args.get('Rendering', 'VIEWS'))
-    views = prepareViews(eulerViews)
-
-    # Set the cuda device
-    device = torch.device("cuda:0")
-    torch.cuda.set_device(device)
-
+def cacheValidationCodes(pipeline, validation_data, mode, cache_dir):
+    # The encoder is frozen, so the codes of the fixed validation images
+    # only have to be computed once
+    if(mode == "none"):
+        return
+    for obj_id,v in enumerate(validation_data):
+        for k,batch in enumerate(v):
+            codes = pipeline.encode(batch["images"])
+            if(mode == "memmap"):
+                prepareDir(cache_dir)
+                file_name = os.path.join(cache_dir, "obj{0}-rank{1}-batch{2}.npy".format(obj_id, rank, k))
+                v.codes[k] = np.lib.format.open_memmap(file_name, mode="w+",
+                                                       dtype=np.float32, shape=codes.shape)
+                v.codes[k][:] = codes
+            else:
+                v.codes[k] = torch.tensor(codes, device=pipeline.device, dtype=torch.float32)
+    print("Cached the validation codes ({0})".format(mode))
+
+def scheduledImageSize(schedule, epoch, default_size):
+    # Schedule as [[start_epoch, image_size], ...], the last started entry is used
+    image_size = default_size
+    for start_epoch, size in sorted(schedule):
+        if(epoch >= start_epoch):
+            image_size = size
+    return image_size
+
+def memoryComponents(br, dataset):
+    # Holders of long-lived tensors and buffers for the memory report
+    components = {"renderer_meshes": [br.padded_vertices, br.padded_faces, br.padded_textures],
+                  "renderer_batch_meshes": br.cachedMeshTensors()}
+    if(hasattr(dataset, "memory_usage")):
+        components.update(dataset.memory_usage())
+    return components
+
+def stepCheckpointPath(output_path):
+    # Kept outside of models/ so latestCheckpoint() never picks it up
+    return os.path.join(output_path, "step-checkpoint-rank{0}.pt".format(rank))
+
+def getRngStates(device):
+    states = {"torch": torch.get_rng_state(),
+              "numpy": np.random.get_state(),
+              "random": random.getstate()}
+    if(device.type == "cuda"):
+        states["cuda"] = torch.cuda.get_rng_state(device)
+    if(hasattr(ia, "random") and hasattr(ia.random, "get_global_rng")):
+        states["imgaug"] = ia.random.get_global_rng().state
+    return states
+
+def setRngStates(states, device):
+    torch.set_rng_state(states["torch"])
+    np.random.set_state(states["numpy"])
+    random.setstate(states["random"])
+    if("cuda" in states and device.type == "cuda"):
+        torch.cuda.set_rng_state(states["cuda"], device)
+    if("imgaug" in states):
+        ia.random.get_global_rng().set_state_(states["imgaug"])
+
+def setupModels(args, device, views):
     # Handle loading of multiple object paths
     try:
         model_path_loss = json.loads(args.get('Dataset', 'MODEL_PATH_LOSS'))
@@ -136,6 +145,7 @@ def main():
                      render_method=args.get('Rendering', 'SHADER'),
                      image_size=args.getint('Rendering', 'IMAGE_SIZE'),
                      norm_verts=args.getboolean('Rendering', 'NORMALIZE_VERTICES'))
+    br.max_batch_meshes = args.getint('Rendering', 'MESH_CACHE_SIZE', fallback=16)
 
     # Set size of model output depending on pose representation - deprecated?
     pose_rep = args.get('Training', 'POSE_REPRESENTATION')
@@ -166,6 +176,233 @@ def main():
         model.encoder.state_dict()['weight'].copy_(encoder.encoder_dense_MatMul.state_dict()['weight'])
         model.encoder.state_dict()['bias'].copy_(encoder.encoder_dense_MatMul.state_dict()['bias'])
         encoder.encoder_dense_MatMul = None
+    return br, model, encoder
+
+def setupGTCache(args):
+    # Reuses the GT renders of the loss for recurring rotations if enabled
+    max_entries = args.getint('Training', 'GT_CACHE_SIZE', fallback=0)
+    if(max_entries <= 0):
+        return None
+    return GTRenderCache(max_entries=max_entries,
+                         resolution=args.getfloat('Training', 'GT_CACHE_RESOLUTION', fallback=0.5),
+                         storage=args.get('Training', 'GT_CACHE_STORAGE', fallback='device'))
+
+def loadValidationData(args, pipeline, output_path):
+    # Load the validationset
+    try:
+        valid_data_paths = json.loads(args.get('Dataset', 'VALID_DATA_PATH'))
+    except:
+        valid_data_paths = [args.get('Dataset', 'VALID_DATA_PATH')]
+
+    # Only use every n-th validation batch to reduce the cost
+    subsample = args.getint('Training', 'VALIDATION_SUBSAMPLE', fallback=1)
+
+    validation_data = []
+    for curr_obj_id,v in enumerate(valid_data_paths):
+        curr_data = loadDataset([v],
+                                args.getint('Training', 'BATCH_SIZE'),
+                                obj_id=curr_obj_id)
+        # Each process validates its own share of the batches
+        validation_data.append(curr_data.subsample(subsample).shard(rank, world_size))
+    print("Loaded {0} validation sets!".format(len(validation_data)))
+    cacheValidationCodes(pipeline, validation_data,
+                         args.get('Training', 'VALIDATION_CODE_CACHE', fallback='none'),
+                         os.path.join(output_path, "validation-codes"))
+    return validation_data
+
+def setupDistributed(config):
+    global rank, world_size, dist_device
+    # Started through torchrun or torch.distributed.launch --use_env
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    device_name = config.get('Training', 'DEVICE', fallback='cuda:0')
+    if(world_size == 1):
+        return torch.device(device_name)
+
+    backend = config.get('Training', 'DIST_BACKEND', fallback='gloo')
+    torch.distributed.init_process_group(backend=backend, init_method="env://")
+    rank = torch.distributed.get_rank()
+
+    if(device_name.startswith("cuda")):
+        device = torch.device("cuda:{0}".format(local_rank))
+    else:
+        device = torch.device("cpu")
+        # Split the cores between the processes on this node
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+        torch.set_num_threads(max(1, os.cpu_count()//local_world_size))
+
+    # nccl can only reduce cuda tensors
+    dist_device = device if backend == "nccl" else torch.device("cpu")
+    print("Initialized process {0}/{1} ({2}) on {3}".format(rank, world_size, backend, device))
+    return device
+
+def isMainProcess():
+    return rank == 0
+
+def allReduceMean(values):
+    # Mean over the values of all processes when running distributed
+    values = np.array(values, dtype=np.float64).flatten()
+    if(world_size == 1):
+        return np.mean(values)
+    stats = torch.tensor([np.sum(values), len(values)], dtype=torch.float64, device=dist_device)
+    torch.distributed.all_reduce(stats)
+    return (stats[0]/stats[1]).item()
+
+def broadcastFlag(flag):
+    # Let the main process decide for everyone
+    if(world_size == 1):
+        return flag
+    flag = torch.tensor([1 if flag else 0], device=dist_device)
+    torch.distributed.broadcast(flag, 0)
+    return bool(flag.item())
+
+def sameOnAllRanks(values):
+    # True if every process passes the same integers
+    if(world_size == 1):
+        return True
+    low = torch.tensor(values, dtype=torch.int64, device=dist_device)
+    high = low.clone()
+    torch.distributed.all_reduce(low, op=torch.distributed.ReduceOp.MIN)
+    torch.distributed.all_reduce(high, op=torch.distributed.ReduceOp.MAX)
+    return bool(torch.equal(low, high))
+
+def loadDataset(file_list, batch_size=2, obj_id=0):
+    datasets = []
+    for f in file_list:
+        print("Loading dataset: {0}".format(f))
+        if(isCompactDataset(f)):
+            datasets.append(ValidationSet.from_compact(f, batch_size, obj_id))
+        else:
+            datasets.append(ValidationSet.from_pickle(f, batch_size, obj_id))
+    if(len(datasets) == 1):
+        return datasets[0]
+    # Keep the stored images (uint8 for the compact format) and convert them per batch,
+    # only a mix of pickles and compact sets has to be converted up front
+    scales = set([d.scale for d in datasets])
+    if(len(scales) == 1):
+        images = np.concatenate([d.images for d in datasets])
+        scale = scales.pop()
+    else:
+        images = np.concatenate([d.images.astype(np.float32)*d.scale for d in datasets])
+        scale = 1.0
+    return ValidationSet(images,
+                         np.concatenate([d.Rs for d in datasets]),
+                         np.concatenate([d.ids for d in datasets]),
+                         batch_size, scale=scale)
+
+def openMetrics(output_path):
+    # Metrics of runs started before the store existed are taken from the CSVs
+    store = MetricsStore(os.path.join(output_path, "metrics.sqlite"))
+    if(store.is_empty()):
+        store.import_csvs(output_path)
+    return store
+
+def validationWorker(args, output_path, device_name, stop_event):
+    # Validates the latest checkpoint whenever a new one appears, runs in its own process
+    global views, epoch, pipeline, gt_cache
+    device = torch.device(device_name)
+    if(device.type == "cuda"):
+        torch.cuda.set_device(device)
+    views = prepareViews(json.loads(args.get('Rendering', 'VIEWS')))
+    br, model, encoder = setupModels(args, device, views)
+    pipeline = Pipeline(encoder, model, device,
+                        precision=args.get('Training', 'PRECISION', fallback='fp32'))
+    encoder.eval()
+    model.eval()
+    gt_cache = setupGTCache(args)
+
+    try:
+        translations = np.array(json.loads(args.get('Rendering', 'T')))
+    except:
+        translations = [np.array(json.loads(args.get('Rendering', 'T')))]
+    validation_data = loadValidationData(args, pipeline, output_path)
+    validate_every = args.getint('Training', 'VALIDATE_EVERY', fallback=1)
+
+    model_dir = os.path.join(output_path, "models/")
+    store = MetricsStore(os.path.join(output_path, "metrics.sqlite"))
+    results = store.series("val_loss")
+    last_epoch = results[-1][0] if len(results) > 0 else -1
+    while True:
+        stopping = stop_event.is_set()
+        checkpoints = {}
+        for path in glob.glob(os.path.join(model_dir, "model-epoch*.pt")):
+            curr_epoch = int(re.search(r'model-epoch(\d+)\.pt$', path).group(1))
+            if(curr_epoch > last_epoch and curr_epoch % validate_every == 0):
+                checkpoints[curr_epoch] = path
+        if(len(checkpoints) == 0):
+            if(stopping):
+                break
+            time.sleep(5.0)
+            continue
+
+        # Skip ahead to the most recent checkpoint
+        epoch = max(checkpoints.keys())
+        try:
+            checkpoint = torch.load(checkpoints[epoch], map_location=device)
+        except (IOError, EOFError, RuntimeError) as e:
+            # Removed by the retention policy in the meantime or unreadable, skip the epoch
+            print("Skipping the validation of epoch {0}, loading the checkpoint failed: {1}".format(epoch, e))
+            last_epoch = epoch
+            time.sleep(5.0)
+            continue
+        model.load_state_dict(checkpoint['model'])
+        last_epoch = epoch
+
+        val_loss_list = []
+        for curr_obj_id,v in enumerate(validation_data):
+            val_loss = runEpoch(br, v, model, device, output_path, t=translations, config=args)
+            val_loss_list.append(val_loss)
+            append2file([val_loss], os.path.join(output_path,
+                                                 "validation-obj{0}-loss.csv".format(curr_obj_id)))
+            store.log_epoch(epoch, **{"val_obj{0}_loss".format(curr_obj_id): val_loss})
+        val_loss = np.mean(np.array(val_loss_list))
+        append2file([val_loss], os.path.join(output_path, "validation-loss.csv"))
+        append2file([epoch], os.path.join(output_path, "validation-epochs.csv"))
+        # Picked up by the training process, which also redraws the plots
+        store.log_epoch(epoch, val_loss=val_loss)
+        print("Validated epoch: {0} - validation loss: {1}".format(epoch, val_loss))
+    store.close()
+
+def main():
+    global optimizer, lr_reducer, grad_scaler, checkpoint_writer, step_writer, image_writer, profiler, metrics, gt_cache, views, epoch, pipeline
+    # Read configuration file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("experiment_name")
+    parser.add_argument("--local_rank", type=int, default=0) # Set by torch.distributed.launch
+    arguments = parser.parse_args()
+
+    if(arguments.experiment_name.startswith('./experiments')):
+        cfg_file_path = arguments.experiment_name
+    else:
+        cfg_file_path = os.path.join("./experiments", arguments.experiment_name)
+    args = configparser.ConfigParser()
+    args.read(cfg_file_path)
+
+    # Set random seed
+    seed=args.getint('Training', 'RANDOM_SEED')
+    if(seed is not None):
+        torch.manual_seed(seed)
+        #torch.use_deterministic_algorithms(True) # Requires pytorch>=1.8.0
+        #torch.backends.cudnn.deterministic = True
+        np.random.seed(seed=seed)
+        ia.seed(seed)
+        random.seed(seed)
+
+    model_seed=args.getint('Training', 'MODEL_RANDOM_SEED', fallback=None)
+    if(model_seed is not None):
+        torch.manual_seed(model_seed)
+
+    # Prepare rotation matrices for multi view loss function
+    eulerViews = json.loads(args.get('Rendering', 'VIEWS'))
+    views = prepareViews(eulerViews)
+
+    # Set the device, one per process when training distributed
+    device = setupDistributed(args)
+    if(device.type == "cuda"):
+        torch.cuda.set_device(device)
+
+    br, model, encoder = setupModels(args, device, views)
+    gt_cache = setupGTCache(args)
 
     # Create an optimizer. Here we are using Adam and we pass in the parameters of the model
     low_lr = args.getfloat('Training', 'LEARNING_RATE_LOW')
@@ -176,10 +413,15 @@ def main():
     else:
         lr_reducer = None
 
+    # Setup mixed precision, only fp16 needs gradient scaling
+    precision = args.get('Training', 'PRECISION', fallback='fp32')
+    grad_scaler = torch.cuda.amp.GradScaler(enabled=(precision == 'fp16' and device.type == 'cuda'))
+
     # Prepare output directories
     output_path = args.get('Training', 'OUTPUT_PATH')
-    prepareDir(output_path)
-    shutil.copy(cfg_file_path, os.path.join(output_path, cfg_file_path.split("/")[-1]))
+    if(isMainProcess()):
+        prepareDir(output_path)
+        shutil.copy(cfg_file_path, os.path.join(output_path, cfg_file_path.split("/")[-1]))
 
     # Setup early stopping if enabled
     early_stopping = args.getboolean('Training', 'EARLY_STOPPING', fallback=False)
@@ -194,7 +436,7 @@ def main():
     # Load checkpoint for last epoch if it exists
     model_path = latestCheckpoint(os.path.join(output_path, "models/"))
     if(model_path is not None):
-        checkpoint = torch.load(model_path)
+        checkpoint = torch.load(model_path, map_location=device)
         epoch = checkpoint['epoch'] + 1
 
         # Load model
@@ -208,29 +450,124 @@ def main():
             lr_reducer.load_state_dict(checkpoint['lr_reducer'])
         except:
             lr_reducer = None
+
+        # Load gradient scaler if it exists
+        if(checkpoint.get('grad_scaler') is not None):
+            grad_scaler.load_state_dict(checkpoint['grad_scaler'])
         print("Loaded the checkpoint: \n" + model_path)
 
+    # Continue in the middle of the epoch if a step checkpoint for it exists,
+    # every process must resume at the same step or all start the epoch over
+    resume_state = None
+    step_checkpoint = None
+    step_position = [-1, -1]
+    step_path = stepCheckpointPath(output_path)
+    if(os.path.exists(step_path)):
+        step_checkpoint = torch.load(step_path, map_location="cpu")
+        if(step_checkpoint['epoch'] == epoch):
+            step_position = [step_checkpoint['epoch'], step_checkpoint['step']]
+    if(not sameOnAllRanks(step_position)):
+        print("The step checkpoints of the processes differ, starting epoch {0} from the beginning".format(epoch))
+    elif(step_position[0] == epoch):
+        model.load_state_dict(step_checkpoint['model'])
+        optimizer.load_state_dict(step_checkpoint['optimizer'])
+        if(lr_reducer is not None and step_checkpoint['lr_reducer'] is not None):
+            lr_reducer.load_state_dict(step_checkpoint['lr_reducer'])
+        grad_scaler.load_state_dict(step_checkpoint['grad_scaler'])
+        resume_state = step_checkpoint
+        print("Loaded the step checkpoint: {0} (epoch {1}, step {2})".format(step_path, epoch,
+                                                                             step_checkpoint['step']))
+
+    # Per-phase timing of the training loop
+    phase_timer.enabled = args.getboolean('Training', 'TIMING', fallback=False)
+    phase_timer.sync = args.getboolean('Training', 'TIMING_SYNC', fallback=True)
+    phase_timer.device = device
+
+    # Memory accounting per phase
+    if(args.getboolean('Training', 'MEMORY_REPORT', fallback=False)):
+        phase_timer.memory = MemoryTracker(device)
+
+    # Optionally trace a window of training steps with torch.profiler
+    profile_steps = args.getint('Training', 'PROFILE_STEPS', fallback=0)
+    if(profile_steps > 0 and isMainProcess()):
+        if(hasattr(torch, "profiler")):
+            profile_start = args.getint('Training', 'PROFILE_START', fallback=10)
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if(device.type == "cuda"):
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            profiler = torch.profiler.profile(activities=activities,
+                                              schedule=torch.profiler.schedule(wait=max(0, profile_start-1),
+                                                                               warmup=min(1, profile_start),
+                                                                               active=profile_steps,
+                                                                               repeat=1),
+                                              on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                                                  os.path.join(output_path, "profiler")))
+            profiler.start()
+        else:
+            print("torch.profiler is not available in this version of pytorch, not profiling!")
+
+    # Render debug images in separate processes
+    if(args.getboolean('Training', 'SAVE_IMAGES') and isMainProcess()):
+        image_writer = ImageWriter(num_workers=args.getint('Training', 'SAVE_IMAGES_WORKERS', fallback=1),
+                                   max_pending=args.getint('Training', 'SAVE_IMAGES_QUEUE', fallback=8),
+                                   every=args.getint('Training', 'SAVE_IMAGES_EVERY', fallback=1))
+
+    # Write checkpoints in the background, only done by the main process
+    if(isMainProcess()):
+        model_dir = os.path.join(output_path, "models/")
+        prepareDir(model_dir)
+        checkpoint_writer = CheckpointWriter(model_dir,
+                                             keep_last=args.getint('Training', 'CHECKPOINT_KEEP_LAST', fallback=0),
+                                             keep_every=args.getint('Training', 'CHECKPOINT_KEEP_EVERY', fallback=0),
+                                             keep_best=args.getboolean('Training', 'CHECKPOINT_KEEP_BEST', fallback=True))
+        checkpoint_writer.validate_every = args.getint('Training', 'VALIDATE_EVERY', fallback=1)
+    # Every process writes its own step checkpoints in the background,
+    # the main process through its checkpoint writer
+    if(args.getint('Training', 'STEP_CHECKPOINT_EVERY', fallback=0) > 0):
+        if(checkpoint_writer is not None):
+            step_writer = checkpoint_writer
+        else:
+            step_writer = CheckpointWriter(os.path.join(output_path, "models/"))
+    # Losses, learning rates and timings are logged to an append-only store,
+    # the loss plots are redrawn from it on a background thread
+    val_results = []
+    plotter = None
+    if(isMainProcess()):
+        metrics = openMetrics(output_path)
+        metrics.truncate_epochs(epoch, resume_state['step'] if resume_state is not None else 0)
+        val_results = metrics.follow("val_loss")
+        if(args.getboolean('Training', 'PLOT_LOSSES', fallback=True)):
+            plotter = LossPlotter(metrics.path, output_path)
+        # Validation losses of earlier runs
+        for e,l in val_results:
+            checkpoint_writer.val_losses[e] = l
+
+    # Validation losses so far, one per validation run
+    val_losses = RunningMean([l for _,l in val_results])
+    val_epochs = [e for e,_ in val_results]
     if early_stopping:
-        validation_csv=os.path.join(output_path, "validation-loss.csv")
-        if os.path.exists(validation_csv):
-            with open(validation_csv) as f:
-                val_reader = csv.reader(f, delimiter='\n')
-                val_loss = list(val_reader)
-            val_losses = np.array(val_loss, dtype=np.float32).flatten()
-            for epoch in range(window,len(val_loss)):
-                timer += 1
-                w_mean = np.mean(val_losses[epoch-window:epoch])
-                window_means.append(w_mean)
-                if w_mean < lowest_mean:
-                    lowest_mean = w_mean
-                    lowest_x = epoch
-                    timer = 0
+        for n in range(window,len(val_losses)):
+            timer += 1
+            w_mean = val_losses.window_mean(n-window, n)
+            window_means.append(w_mean)
+            if w_mean < lowest_mean:
+                lowest_mean = w_mean
+                lowest_x = val_epochs[n]
+                timer = 0
 
 
-    # Prepare pipeline
-    pipeline = Pipeline(encoder, model, device)
+    # Prepare pipeline, the checkpoints always store the unwrapped model
+    if(world_size > 1):
+        ddp_model = torch.nn.parallel.DistributedDataParallel(model,
+                                                              device_ids=[device] if device.type == "cuda" else None)
+        pipeline = Pipeline(encoder, ddp_model, device, precision=precision)
+    else:
+        pipeline = Pipeline(encoder, model, device, precision=precision)
     encoder.eval()
 
+    # Each process gets its own seeds for data generation
+    rank_seed_offset = 100000*rank
+
     # Handle loading of multiple object paths and translations
     try:
         model_path_data = json.loads(args.get('Dataset', 'MODEL_PATH_DATA'))
@@ -240,50 +577,102 @@ def main():
         translations = [np.array(json.loads(args.get('Rendering', 'T')))]
 
 
-    # Check if training based on PBR using DataLoader is enabled
-    try:
-        pbr_path = args.get('Dataset', 'PBR_PATH')
-        obj_ids = json.loads(args.get('Dataset', 'PBR_OBJ_IDS'))
-
-        from DatasetPBR import DatasetGenerator
-        training_dataset = DatasetGenerator(pbr_path, obj_ids)
-        training_data = torch.utils.data.DataLoader(training_dataset, args.getint('Training', 'BATCH_SIZE'), shuffle=True, num_workers=2)
-    except: # Default to old approach in case the above fails
-        # Prepare datasets
-        from DatasetGeneratorOpenGL import DatasetGenerator
-        bg_path = "../../autoencoder_ws/data/VOC2012/JPEGImages/"
-        training_data = DatasetGenerator(args.get('Dataset', 'BACKGROUND_IMAGES'),
-                                         model_path_data,
-                                         translations,
-                                         args.getint('Training', 'BATCH_SIZE'),
-                                         "not_used",
-                                         device,
-                                         sampling_method = args.get('Training', 'VIEW_SAMPLING'),
-                                         max_rel_offset = args.getfloat('Training', 'MAX_REL_OFFSET', fallback=0.2),
-                                         augment_imgs = args.getboolean('Training', 'AUGMENT_IMGS', fallback=True),
-                                         seed=args.getint('Training', 'RANDOM_SEED'))
-        training_data.max_samples = args.getint('Training', 'NUM_SAMPLES')
-
-    # Load the validationset
-    try:
-        valid_data_paths = json.loads(args.get('Dataset', 'VALID_DATA_PATH'))
-    except:
-        valid_data_paths = [args.get('Dataset', 'VALID_DATA_PATH')]
-
-
-    validation_data = []
-    for curr_obj_id,v in enumerate(valid_data_paths):
-        validation_data.append(loadDataset([v],
-                                           args.getint('Training', 'BATCH_SIZE'),
-                                           obj_id=curr_obj_id))
-    print("Loaded {0} validation sets!".format(len(validation_data)))
+    # Train only the pose head on precomputed codes and GT renders if enabled
+    sampler = None
+    head_only_data = args.get('Training', 'HEAD_ONLY_DATA', fallback=None)
+    if(head_only_data is not None):
+        if(model.finetune_encoder):
+            raise ValueError("HEAD_ONLY_DATA can not be used together with FINETUNE_ENCODER")
+        training_data = HeadOnlyDataset(head_only_data, args.getint('Training', 'BATCH_SIZE'), device)
+        if(training_data.info["image_size"] != br.image_size):
+            raise ValueError("HEAD_ONLY_DATA was rendered at image size {0}, not {1}".format(
+                training_data.info["image_size"], br.image_size))
+        training_data.max_samples = min(training_data.max_samples,
+                                        args.getint('Training', 'NUM_SAMPLES')//world_size)
+        if(world_size > 1):
+            training_data.shard(rank, world_size, args.getint('Training', 'RANDOM_SEED'))
+    else:
+        # Check if training based on PBR using DataLoader is enabled
+        try:
+            pbr_path = args.get('Dataset', 'PBR_PATH')
+            obj_ids = json.loads(args.get('Dataset', 'PBR_OBJ_IDS'))
+
+            from DatasetPBR import DatasetGenerator
+            training_dataset = DatasetGenerator(pbr_path, obj_ids)
+            if(world_size > 1):
+                sampler = torch.utils.data.distributed.DistributedSampler(training_dataset)
+            training_data = torch.utils.data.DataLoader(training_dataset, args.getint('Training', 'BATCH_SIZE'),
+                                                        shuffle=(sampler is None), sampler=sampler, num_workers=2)
+        except: # Default to old approach in case the above fails
+            # Prepare datasets
+            from DatasetGeneratorOpenGL import DatasetGenerator
+            bg_path = "../../autoencoder_ws/data/VOC2012/JPEGImages/"
+
+            # Generate batches in separate worker processes if enabled
+            num_workers = args.getint('Training', 'NUM_WORKERS', fallback=0)
+            worker_kwargs = {}
+            if(num_workers > 0):
+                from DatasetGeneratorWorkers import DatasetGeneratorWorkers as DatasetGenerator
+                if("-hard" in args.get('Training', 'VIEW_SAMPLING')):
+                    raise ValueError("The -hard view sampling modes can not be used with NUM_WORKERS > 0")
+                worker_kwargs = dict(num_workers=num_workers,
+                                     prefetch_depth=args.getint('Training', 'PREFETCH_DEPTH', fallback=4))
+
+            training_data = DatasetGenerator(args.get('Dataset', 'BACKGROUND_IMAGES'),
+                                             model_path_data,
+                                             translations,
+                                             args.getint('Training', 'BATCH_SIZE'),
+                                             "not_used",
+                                             device,
+                                             sampling_method = args.get('Training', 'VIEW_SAMPLING'),
+                                             max_rel_offset = args.getfloat('Training', 'MAX_REL_OFFSET', fallback=0.2),
+                                             augment_imgs = args.getboolean('Training', 'AUGMENT_IMGS', fallback=True),
+                                             seed=args.getint('Training', 'RANDOM_SEED') + rank_seed_offset,
+                                             cache_path=args.get('Training', 'RENDER_CACHE', fallback=None),
+                                             cache_shard_size=args.getint('Training', 'RENDER_CACHE_SHARD_SIZE', fallback=1000),
+                                             sample_reuse=args.getint('Training', 'SAMPLE_REUSE', fallback=1),
+                                             reuse_buffer_size=args.getint('Training', 'SAMPLE_REUSE_BUFFER', fallback=1000),
+                                             **worker_kwargs)
+            training_data.max_samples = args.getint('Training', 'NUM_SAMPLES')//world_size
+
+    if(args.getint('Training', 'STEP_CHECKPOINT_EVERY', fallback=0) > 0 and not hasattr(training_data, "get_state")):
+        print("Warning: STEP_CHECKPOINT_EVERY is ignored, the training data ({0}) can not save its state".format(
+            type(training_data).__name__))
+
+    # Load the validationset, done by the validation worker in async mode
+    validation_mode = args.get('Training', 'VALIDATION_MODE', fallback='sync')
+    validate_every = args.getint('Training', 'VALIDATE_EVERY', fallback=1)
+    if(validation_mode == "sync"):
+        validation_data = loadValidationData(args, pipeline, output_path)
+    validation_worker = None
+    if(validation_mode == "async" and isMainProcess()):
+        ctx = mp.get_context("spawn")
+        validation_stop = ctx.Event()
+        validation_worker = ctx.Process(target=validationWorker,
+                                        args=(args, output_path,
+                                              args.get('Training', 'VALIDATION_DEVICE', fallback=str(device)),
+                                              validation_stop))
+        validation_worker.start()
+
+    # Render the loss at a lower resolution in the early epochs if enabled
+    image_size_schedule = json.loads(args.get('Rendering', 'IMAGE_SIZE_SCHEDULE', fallback='[]'))
+    if(len(image_size_schedule) > 0 and head_only_data is not None):
+        raise ValueError("IMAGE_SIZE_SCHEDULE can not be used with the fixed size renders of HEAD_ONLY_DATA")
 
     # Start training
     while(epoch < args.getint('Training', 'NUM_ITER')):
+        if(len(image_size_schedule) > 0):
+            br.setImageSize(scheduledImageSize(image_size_schedule, epoch,
+                                               args.getint('Rendering', 'IMAGE_SIZE')))
+        if(isMainProcess()):
+            print("Epoch: {0} - loss render size: {1}".format(epoch, br.image_size))
+            append2file([br.image_size], os.path.join(output_path, "image-size.csv"))
+            metrics.log_epoch(epoch, image_size=br.image_size)
+
         # Set random seed based on current epoch
         seed=args.getint('Training', 'RANDOM_SEED')
         if(seed is not None):
-            seed += epoch
+            seed += epoch + rank_seed_offset
             torch.manual_seed(seed)
             #torch.use_deterministic_algorithms(True) # Requires pytorch>=1.8.0
             #torch.backends.cudnn.deterministic = True
@@ -297,58 +686,107 @@ def main():
             torch.manual_seed(model_seed)
 
         # Train on synthetic data
+        if(sampler is not None):
+            sampler.set_epoch(epoch)
+        if(hasattr(training_data, "set_epoch")):
+            training_data.set_epoch(epoch)
         model = model.train() # Set model to train mode
         loss = runEpoch(br, training_data, model, device, output_path,
-                          t=translations, config=args)
-        append2file([loss], os.path.join(output_path, "train-loss.csv"))
-        if(lr_reducer is not None):
-            append2file([lr_reducer.get_lr()], os.path.join(output_path, "learning-rate.csv"))
-        else:
-            append2file([optimizer.param_groups[0]['lr']], os.path.join(output_path, "learning-rate.csv"))
+                          t=translations, config=args, resume=resume_state)
+        resume_state = None
+        if(isMainProcess()):
+            lr = lr_reducer.get_lr() if lr_reducer is not None else optimizer.param_groups[0]['lr']
+            append2file([loss], os.path.join(output_path, "train-loss.csv"))
+            append2file([lr], os.path.join(output_path, "learning-rate.csv"))
+            metrics.log_epoch(epoch, train_loss=loss, lr=lr)
 
         # Test on validation data
-        model = model.eval() # Set model to eval mode
-        val_loss_list = []
-        for curr_obj_id,v in enumerate(validation_data):
-            val_loss = runEpoch(br, v, model, device, output_path, t=translations, config=args)
-            val_loss_list.append(val_loss)
-            append2file([val_loss], os.path.join(output_path,
-                                                 "validation-obj{0}-loss.csv".format(curr_obj_id)))
-            plotLoss(os.path.join(output_path, "train-loss.csv"),
-                     os.path.join(output_path, "validation-obj{0}-loss.png".format(curr_obj_id)),
-                     validation_csv=os.path.join(output_path,"validation-obj{0}-loss.csv".format(curr_obj_id)))
-        val_loss = np.mean(np.array(val_loss_list))
-        append2file([val_loss], os.path.join(output_path, "validation-loss.csv"))
-
-        # Plot losses
-        val_losses = plotLoss(os.path.join(output_path, "train-loss.csv"),
-                 os.path.join(output_path, "train-loss.png"),
-                 validation_csv=os.path.join(output_path, "validation-loss.csv"))
-        print("-"*20)
-        print("Epoch: {0} - train loss: {1} - validation loss: {2}".format(epoch,loss,val_loss))
-        print("-"*20)
-        if early_stopping and epoch >= window:
-            timer += 1
-            if timer > time_limit:
-                # print stuff here
-                print()
-                print("-"*60)
-                print("Validation loss seems to have plateaued, stopping early.")
-                print("Best mean loss value over an epoch window of size {} was found at epoch {} ({:.8f} mean loss)".format(window, lowest_x, lowest_mean))
-                print("-"*60)
-                break
-            w_mean = np.mean(val_losses[epoch-window:epoch])
-            window_means.append(w_mean)
-            if w_mean < lowest_mean:
-                lowest_mean = w_mean
-                lowest_x = epoch
-                timer = 0
+        new_val_results = []
+        if(validation_mode == "sync" and epoch % validate_every == 0):
+            model = model.eval() # Set model to eval mode
+            # Always validate at the final resolution, the losses of the early
+            # stopping window would not be comparable otherwise
+            train_image_size = br.image_size
+            br.setImageSize(args.getint('Rendering', 'IMAGE_SIZE'))
+            val_loss_list = []
+            for curr_obj_id,v in enumerate(validation_data):
+                val_loss = runEpoch(br, v, model, device, output_path, t=translations, config=args)
+                val_loss_list.append(val_loss)
+                if(isMainProcess()):
+                    append2file([val_loss], os.path.join(output_path,
+                                                         "validation-obj{0}-loss.csv".format(curr_obj_id)))
+                    metrics.log_epoch(epoch, **{"val_obj{0}_loss".format(curr_obj_id): val_loss})
+            val_loss = np.mean(np.array(val_loss_list))
+            br.setImageSize(train_image_size)
+
+            if(isMainProcess()):
+                append2file([val_loss], os.path.join(output_path, "validation-loss.csv"))
+                append2file([epoch], os.path.join(output_path, "validation-epochs.csv"))
+                metrics.log_epoch(epoch, val_loss=val_loss)
+        if(isMainProcess()):
+            # Validation results of this epoch or the validation worker
+            new_val_results = metrics.follow("val_loss")
+            if(plotter is not None):
+                plotter.request()
+
+        stop_training = False
+        if(isMainProcess()):
+            print("-"*20)
+            print("Epoch: {0} - train loss: {1} - validation loss: {2}".format(epoch,loss,
+                      new_val_results[-1][1] if len(new_val_results) > 0 else "n/a"))
+            print("-"*20)
+
+        for val_epoch,val_loss in new_val_results:
+            checkpoint_writer.set_val_loss(val_epoch, val_loss)
+            val_losses.append(val_loss)
+            n = len(val_losses) - 1
+            if early_stopping and n >= window and not stop_training:
+                timer += 1
+                if timer > time_limit:
+                    # print stuff here
+                    print()
+                    print("-"*60)
+                    print("Validation loss seems to have plateaued, stopping early.")
+                    print("Best mean loss value over an epoch window of size {} was found at epoch {} ({:.8f} mean loss)".format(window, lowest_x, lowest_mean))
+                    print("-"*60)
+                    stop_training = True
+                else:
+                    w_mean = val_losses.window_mean(n-window, n)
+                    window_means.append(w_mean)
+                    if w_mean < lowest_mean:
+                        lowest_mean = w_mean
+                        lowest_x = val_epoch
+                        timer = 0
+        if(broadcastFlag(stop_training)):
+            break
         epoch = epoch+1
 
+    # Wait for the last checkpoints and images to be written
+    if(hasattr(training_data, "close")):
+        # Stops the dataset workers and frees their shared memory
+        training_data.close()
+    if(checkpoint_writer is not None):
+        checkpoint_writer.close()
+    if(step_writer is not None and step_writer is not checkpoint_writer):
+        step_writer.close()
+    if(validation_worker is not None):
+        # Validates the remaining checkpoints before stopping
+        validation_stop.set()
+        validation_worker.join()
+    if(image_writer is not None):
+        image_writer.close()
+    if(profiler is not None):
+        profiler.stop()
+    if(plotter is not None):
+        # Final plot including the results of the validation worker
+        plotter.request()
+        plotter.close()
+    if(metrics is not None):
+        metrics.close()
+
 def runEpoch(br, dataset, model,
-               device, output_path, t, config):
-    global optimizer, lr_reducer
-    dbg("Before train memory: {}".format(torch.cuda.memory_summary(device=device, abbreviated=False)), dbg_memory)
+               device, output_path, t, config, resume=None):
+    global optimizer, lr_reducer, grad_scaler
 
     if(model.training):
         print("Current mode: train!")
@@ -357,6 +795,8 @@ def runEpoch(br, dataset, model,
         else:
             print("Epoch: {0} - current learning rate: {1}".format(epoch, optimizer.param_groups[0]['lr']))
         dataset.hard_samples = [] # Reset hard samples
+        if(hasattr(dataset, "reset_reuse_stats")):
+            dataset.reset_reuse_stats()
         torch.set_grad_enabled(True)
     else:
         print("Current mode: eval!")
@@ -366,9 +806,41 @@ def runEpoch(br, dataset, model,
     batch_size = br.batch_size
     hard_indeces = []
 
-    for i,curr_batch in enumerate(dataset):
-        if(model.training):
-            optimizer.zero_grad()
+    # Split batches into micro-batches for rendering and backward,
+    # and accumulate gradients over several batches before stepping
+    micro_batch = config.getint('Training', 'MICRO_BATCH', fallback=0)
+    accumulation_steps = config.getint('Training', 'ACCUMULATION_STEPS', fallback=1)
+    if(0 < micro_batch < 2):
+        # BatchNorm1d can not normalize a single sample in training mode
+        raise ValueError("MICRO_BATCH must be 0 or at least 2, got {0}".format(micro_batch))
+
+    phase_timer.reset_epoch()
+    if(phase_timer.memory is not None):
+        phase_timer.memory.reset_epoch()
+        phase_timer.memory.components = lambda: memoryComponents(br, dataset)
+    timing_file = os.path.join(output_path, "train-timing.jsonl")
+
+    # Periodic step checkpoints need a data generator that can save its state
+    step_checkpoint_every = 0
+    if(model.training and hasattr(dataset, "get_state")):
+        step_checkpoint_every = config.getint('Training', 'STEP_CHECKPOINT_EVERY', fallback=0)
+
+    data_iter = iter(dataset)
+    start_step = 0
+    if(resume is not None):
+        # Continue with the same sample stream as the interrupted run
+        start_step = resume['step']
+        losses = list(resume['losses'])
+        if(hasattr(dataset, "set_state")):
+            dataset.set_state(resume['dataset'])
+        setRngStates(resume['rng'], device)
+
+    phase_timer.start()
+    for i,curr_batch in enumerate(data_iter, start_step):
+        phase_timer.stop("data")
+        if(model.training and i % accumulation_steps == 0):
+            with phase_timer.phase("optimizer"):
+                optimizer.zero_grad()
 
         if(isinstance(dataset, torch.utils.data.DataLoader)):
             # We must be using DataLoader
@@ -382,29 +854,80 @@ def runEpoch(br, dataset, model,
         # Fetch images
         input_images = curr_batch["images"]
 
-        # Predict poses
-        predicted_poses = pipeline.process(input_images)
-
         # Prepare ground truth poses for the loss function
-        T = np.array(t, dtype=np.float32)
         Rs = curr_batch["Rs"]
         ids = curr_batch["ids"]
         ts = [np.array(t[curr_id], dtype=np.float32) for curr_id in ids]
 
-        # Calculate the loss
-        loss, batch_loss, gt_images, predicted_images = Loss(predicted_poses, Rs, br,
-                                                             ts,
-                                                             ids=ids,
-                                                             views=views,
-                                                             config=config)
+        num_samples = len(Rs)
+        chunk_size = micro_batch if micro_batch > 0 else num_samples
+        chunks = [[start, min(start + chunk_size, num_samples)] for start in range(0, num_samples, chunk_size)]
+        if(len(chunks) > 1 and chunks[-1][1] - chunks[-1][0] < 2):
+            # Fold a single remaining sample into the previous micro-batch for BatchNorm1d
+            chunks[-2][1] = chunks.pop()[1]
+        batch_losses = []
+        batch_poses = []
+        gt_images = None
+        predicted_images = None
+        step_optimizer = (i+1) % accumulation_steps == 0 or (i+1) == len(dataset)
+        # The last accumulation group of the epoch can have fewer batches
+        group_start = (i//accumulation_steps)*accumulation_steps
+        group_size = max(1, min(accumulation_steps, len(dataset) - group_start))
+        for start,end in chunks:
+
+            # Only synchronize gradients between processes before an optimizer step
+            if(model.training and hasattr(pipeline.model, "no_sync") and not (step_optimizer and end == num_samples)):
+                sync_context = pipeline.model.no_sync()
+            else:
+                sync_context = contextlib.suppress()
+
+            with sync_context:
+                # Predict poses, using the cached codes if available
+                if("codes" in curr_batch):
+                    predicted_poses = pipeline.predict(curr_batch["codes"][start:end])
+                else:
+                    predicted_poses = pipeline.process(input_images[start:end])
+
+                # Calculate the loss, the renders are timed separately
+                with phase_timer.phase("loss"):
+                    cached_gt_images = curr_batch.get("gt_images")
+                    if(cached_gt_images is not None):
+                        cached_gt_images = cached_gt_images[start:end]
+                    loss, chunk_loss, chunk_gt_images, chunk_predicted_images = Loss(predicted_poses, Rs[start:end], br,
+                                                                                     ts[start:end],
+                                                                                     ids=ids[start:end],
+                                                                                     views=views,
+                                                                                     config=config,
+                                                                                     cached_gt_images=cached_gt_images,
+                                                                                     gt_cache=gt_cache)
+                    if(phase_timer.memory is not None):
+                        phase_timer.memory.hold("loss_images", [chunk_gt_images, chunk_predicted_images])
+
+                # Weight each micro-batch by its share of the accumulation group. The gradients
+                # only match the full batch up to BatchNorm1d, which normalizes with
+                # the statistics of the micro-batch and updates its running
+                # statistics once per micro-batch
+                if(model.training):
+                    weight = (end - start)/(num_samples*group_size)
+                    with phase_timer.phase("backward"):
+                        grad_scaler.scale(loss*weight).backward()
+
+            batch_losses.append(chunk_loss.detach())
+            batch_poses.append(predicted_poses.detach())
+            if(start == 0 and chunk_gt_images is not None): # Keep the first micro-batch for plotting
+                gt_images = chunk_gt_images.detach()
+                predicted_images = chunk_predicted_images.detach()
+
+        batch_loss = torch.cat(batch_losses)
+        predicted_poses = torch.cat(batch_poses)
+        loss = torch.mean(batch_loss)
 
         Rs = torch.tensor(np.stack(Rs), device=device, dtype=torch.float32)
 
-        print("Grad: ", loss.requires_grad)
-
-        if(model.training):
-            loss.backward()
-            optimizer.step()
+        if(model.training and step_optimizer):
+            with phase_timer.phase("optimizer"):
+                grad_scaler.step(optimizer)
+                grad_scaler.update()
 
             # # DEBUG! REMOVE
             # print("Encoder conv: ", torch.sum(pipeline.encoder.encoder_conv2d_Conv2D.weight))
@@ -414,8 +937,6 @@ def runEpoch(br, dataset, model,
 
         #detach all from gpu
         loss.detach().cpu().numpy()
-        gt_images.detach().cpu().numpy()
-        predicted_images.detach().cpu().numpy()
 
 
         # Check for nan loss
@@ -423,51 +944,109 @@ def runEpoch(br, dataset, model,
             print("nan loss !!!! OH NOOOOO!!!")
             stop
 
-        
-        if(model.training):
-            print("Batch: {0}/{1} (size: {2}) - loss: {3}".format(i+1,len(dataset), len(Rs),torch.mean(batch_loss)))
-        else:
-            print("Test batch: {0}/{1} (size: {2}) - loss: {3}".format(i+1,len(dataset), len(Rs),torch.mean(batch_loss)))
-            #print("Test batch: {0}/{1} (size: {2}) - loss: {3}".format(i+1, round(dataset.max_samples/batch_size), len(Rs),torch.mean(batch_loss)))
-        losses = losses + batch_loss.data.detach().cpu().numpy().tolist()
-
-        if(config.getboolean('Training', 'SAVE_IMAGES')):
+        with phase_timer.phase("logging"):
             if(model.training):
-                batch_img_dir = os.path.join(output_path, "images/epoch{0}".format(epoch))
+                print("Batch: {0}/{1} (size: {2}) - loss: {3}".format(i+1,len(dataset), len(Rs),torch.mean(batch_loss)))
             else:
-                batch_img_dir = os.path.join(output_path, "val-images/epoch{0}/obj{1}".format(epoch,ids[0]))
-            prepareDir(batch_img_dir)
-            gt_img = (gt_images[0]).detach().cpu().numpy()
-            predicted_img = (predicted_images[0]).detach().cpu().numpy()
-
-            vmin = np.linalg.norm(T)*0.9
-            vmax = max(np.max(gt_img), np.max(predicted_img))
-
-            fig = plt.figure(figsize=(12,3+len(views)*2))
-            #for viewNum in np.arange(len(views)):
-            plotView(0, len(views), vmin, vmax, input_images, gt_images, predicted_images,
-                     predicted_poses, batch_loss, batch_size, threshold=config['Loss_parameters'].getfloat('DEPTH_MAX'))
-            fig.tight_layout()
-
-            fig.savefig(os.path.join(batch_img_dir, "epoch{0}-batch{1}.png".format(epoch,i)), dpi=fig.dpi)
-            plt.close()
+                print("Test batch: {0}/{1} (size: {2}) - loss: {3}".format(i+1,len(dataset), len(Rs),torch.mean(batch_loss)))
+                #print("Test batch: {0}/{1} (size: {2}) - loss: {3}".format(i+1, round(dataset.max_samples/batch_size), len(Rs),torch.mean(batch_loss)))
+            if(not curr_batch.get("padding", False)):
+                # Padding batches only keep the processes in step, the mean is over the real samples
+                losses = losses + batch_loss.data.detach().cpu().numpy().tolist()
+
+            if(image_writer is not None and image_writer.should_save(i) and input_images is not None and gt_images is not None):
+                if(model.training):
+                    batch_img_dir = os.path.join(output_path, "images/epoch{0}".format(epoch))
+                else:
+                    batch_img_dir = os.path.join(output_path, "val-images/epoch{0}/obj{1}".format(epoch,ids[0]))
+                image_writer.submit(os.path.join(batch_img_dir, "epoch{0}-batch{1}.png".format(epoch,i)),
+                                    len(views), input_images, gt_images, predicted_images,
+                                    predicted_poses, batch_loss, batch_size,
+                                    threshold=config['Loss_parameters'].getfloat('DEPTH_MAX'))
+
+        batch_times = phase_timer.end_batch(len(Rs))
+        if(phase_timer.enabled and isMainProcess()):
+            record = {"epoch": epoch, "batch": i,
+                      "mode": "train" if model.training else "eval",
+                      "samples": len(Rs)}
+            record.update(batch_times)
+            appendJson(record, timing_file)
+        if(metrics is not None):
+            metrics.log_batch(epoch, i, "train" if model.training else "eval",
+                              loss=torch.mean(batch_loss).item(), samples=len(Rs), **batch_times)
+        if(model.training and profiler is not None):
+            profiler.step()
+
+        # Save the position within the epoch, only between optimizer steps
+        if(step_checkpoint_every > 0 and step_optimizer and (i+1) % step_checkpoint_every == 0 and (i+1) < len(dataset)):
+            state = {'model': model.state_dict(),
+                     'optimizer': optimizer.state_dict(),
+                     'lr_reducer': lr_reducer.state_dict() if lr_reducer is not None else None,
+                     'grad_scaler': grad_scaler.state_dict(),
+                     'epoch': epoch,
+                     'step': i+1,
+                     'losses': losses,
+                     'rng': getRngStates(device),
+                     'dataset': dataset.get_state()}
+            step_writer.save_step(state, stepCheckpointPath(output_path))
+            if(metrics is not None):
+                metrics.commit()
+        phase_timer.start()
+    phase_timer.stop("data")
+
+    if(phase_timer.enabled and isMainProcess()):
+        summary = phase_timer.summary()
+        print("Epoch: {0} - {1:.1f} samples/sec - phase shares: {2}".format(epoch,
+                  summary["samples_per_sec"],
+                  ", ".join(["{0} {1:.1%}".format(k,v) for k,v in summary["shares"].items()])))
+        summary.update({"epoch": epoch, "mode": "train" if model.training else "eval", "summary": True})
+        appendJson(summary, timing_file)
+        if(metrics is not None and model.training):
+            metrics.log_epoch(epoch, samples_per_sec=summary["samples_per_sec"], wall_time=summary["wall_time"])
+
+    if(metrics is not None):
+        metrics.commit()
+
+    if(phase_timer.memory is not None and isMainProcess()):
+        report = phase_timer.memory.report()
+        report.update({"epoch": epoch, "mode": "train" if model.training else "eval"})
+        appendJson(report, os.path.join(output_path, "memory-report.jsonl"))
+        print("Epoch: {0} - peak process RSS: {1:.0f} MB - peak CUDA: {2:.0f} MB".format(epoch, report["peak_process_rss_mb"],
+                                                                                        report.get("cuda_peak_mb", 0.0)))
+
+    if(gt_cache is not None and isMainProcess()):
+        cache_stats = gt_cache.get_stats()
+        print("Epoch: {0} - GT render cache hit rate: {1:.1%} ({2} entries)".format(epoch,
+                                                                                   cache_stats["hit_rate"],
+                                                                                   cache_stats["entries"]))
+        if(metrics is not None):
+            mode = "train" if model.training else "val"
+            metrics.log_epoch(epoch, **{"{0}_gt_cache_hit_rate".format(mode): cache_stats["hit_rate"]})
+        gt_cache.reset_stats()
+
+    if(model.training and hasattr(dataset, "get_reuse_stats") and isMainProcess()):
+        reuse_stats = dataset.get_reuse_stats()
+        print("Epoch: {0} - fresh samples: {1} - replayed samples: {2}".format(epoch,
+                                                                             reuse_stats["fresh"],
+                                                                             reuse_stats["replayed"]))
+        append2file(["{0},{1}".format(reuse_stats["fresh"], reuse_stats["replayed"])],
+                    os.path.join(output_path, "sample-reuse.csv"))
 
     if(model.training):
         # Save current model
-        model_dir = os.path.join(output_path, "models/")
-        prepareDir(model_dir)
-        state = {'model': model.state_dict(),
-                 'optimizer': optimizer.state_dict(),
-                 'lr_reducer': lr_reducer.state_dict() if lr_reducer is not None else None,
-                 'epoch': epoch}
-        torch.save(state, os.path.join(model_dir,"model-epoch{0}.pt".format(epoch)))
+        if(isMainProcess()):
+            state = {'model': model.state_dict(),
+                     'optimizer': optimizer.state_dict(),
+                     'lr_reducer': lr_reducer.state_dict() if lr_reducer is not None else None,
+                     'grad_scaler': grad_scaler.state_dict(),
+                     'epoch': epoch}
+            checkpoint_writer.save(state, epoch)
         if(lr_reducer is not None):
             lr_reducer.step()
 
     # Memory management
-    dbg("After train memory: {}".format(torch.cuda.memory_summary(device=device, abbreviated=False)), dbg_memory)
     gc.collect()
-    return np.mean(losses)
+    return allReduceMean(losses)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+import os
+import resource
+import weakref
+import collections
+import torch
+
+# Memory accounting per phase of the training loop
+#
+# Hooked into the phases of utils.timing.PhaseTimer. For every phase it
+# records the resident set size (RSS) of the process and, on CUDA devices,
+# the allocated tensor memory. The delta is the memory still held when the
+# phase ends (e.g. the rendered image stacks of the loss), a negative delta
+# for the backward pass is the size of the freed autograd graph.
+# The process RSS also contains non-tensor memory and memory the allocator
+# keeps after a free, so it is only an upper bound that may not drop when
+# tensors are freed. There are no allocator statistics for CPU tensors,
+# instead the CPU tensors and arrays of the known holders (renderer meshes,
+# data generator buffers, the GT and predicted image stacks of the loss) are
+# summed at every phase boundary. Tensors outside of these holders (e.g. the
+# activations of the encoder) are only seen in the RSS.
+
+MB = 1024.0*1024.0
+
+def currentRSS():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (IOError, ValueError):
+        return peakRSS()
+
+def peakRSS():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def tensorBytes(obj, cpu_only=False):
+    if(torch.is_tensor(obj)):
+        if(cpu_only and obj.device.type != "cpu"):
+            return 0
+        return obj.element_size()*obj.nelement()
+    if(hasattr(obj, "nbytes")):
+        return obj.nbytes
+    if(isinstance(obj, (list, tuple))):
+        return sum([tensorBytes(o, cpu_only) for o in obj])
+    if(isinstance(obj, dict)):
+        return sum([tensorBytes(o, cpu_only) for o in obj.values()])
+    return 0
+
+class MemoryTracker():
+    def __init__(self, device):
+        self.device = device
+        self.cuda = device.type == "cuda"
+        self.stack = []
+        self.components = lambda: {} # Returns the long-lived holders, set per epoch
+        self.held = {} # Weak references to short-lived tensors, e.g. the loss images
+        self.reset_epoch()
+
+    def hold(self, name, tensors):
+        # Only weak references, accounting must not keep the tensors alive
+        self.held[name] = [weakref.ref(t) for t in tensors if t is not None]
+
+    def cpuTensorBytes(self):
+        held = [[r() for r in refs] for refs in self.held.values()]
+        return tensorBytes(self.components(), cpu_only=True) + tensorBytes([t for h in held for t in h if t is not None],
+                                                                           cpu_only=True)
+
+    def reset_epoch(self):
+        self.phases = collections.OrderedDict()
+        if(self.cuda):
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def begin(self):
+        entry = {"rss": currentRSS(), "cpu_tensors": self.cpuTensorBytes(), "cuda": 0, "cuda_peak": 0}
+        if(self.cuda):
+            # The peak counter is shared, hand the peak so far to the enclosing phase
+            if(len(self.stack) > 0):
+                self.stack[-1]["cuda_peak"] = max(self.stack[-1]["cuda_peak"],
+                                                  torch.cuda.max_memory_allocated(self.device))
+            entry["cuda"] = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.stack.append(entry)
+
+    def end(self, name):
+        entry = self.stack.pop()
+        stats = self.phases.setdefault(name, {"calls": 0,
+                                              "process_rss_mb": 0.0, "process_rss_delta_mb": 0.0,
+                                              "cpu_tensors_mb": 0.0, "cpu_tensors_delta_mb": 0.0,
+                                              "cuda_peak_mb": 0.0, "cuda_delta_mb": 0.0})
+        rss = currentRSS()
+        cpu_tensors = self.cpuTensorBytes()
+        stats["calls"] += 1
+        stats["process_rss_mb"] = max(stats["process_rss_mb"], rss/MB)
+        stats["process_rss_delta_mb"] += (rss - entry["rss"])/MB
+        stats["cpu_tensors_mb"] = max(stats["cpu_tensors_mb"], cpu_tensors/MB)
+        stats["cpu_tensors_delta_mb"] += (cpu_tensors - entry["cpu_tensors"])/MB
+        if(self.cuda):
+            peak = max(entry["cuda_peak"], torch.cuda.max_memory_allocated(self.device))
+            stats["cuda_peak_mb"] = max(stats["cuda_peak_mb"], peak/MB)
+            stats["cuda_delta_mb"] += (torch.cuda.memory_allocated(self.device) - entry["cuda"])/MB
+            if(len(self.stack) > 0):
+                self.stack[-1]["cuda_peak"] = max(self.stack[-1]["cuda_peak"], peak)
+
+    def report(self):
+        # Deltas are reported as the mean per call
+        phases = collections.OrderedDict()
+        for name,stats in self.phases.items():
+            phases[name] = dict(stats)
+            for k in ["process_rss_delta_mb", "cpu_tensors_delta_mb", "cuda_delta_mb"]:
+                phases[name][k] = stats[k]/stats["calls"]
+        report = {"peak_process_rss_mb": peakRSS()/MB,
+                  "cpu_memory": "process RSS and the CPU tensors of the tracked holders",
+                  "phases": phases,
+                  "components_mb": {k: tensorBytes(v)/MB for k,v in self.components().items()}}
+        if(self.cuda):
+            report["cuda_peak_mb"] = max([0.0] + [p["cuda_peak_mb"] for p in phases.values()])
+            report["cuda_reserved_mb"] = torch.cuda.memory_reserved(self.device)/MB
+        return report
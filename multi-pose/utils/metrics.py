@@ -0,0 +1,169 @@
+import os
+import csv
+import sqlite3
+import threading
+
+# Append-only metrics store of a training run (OUTPUT_PATH/metrics.sqlite)
+#
+#   epochs  - one row per epoch and metric, e.g. train_loss, lr, val_loss
+#   batches - one row per batch and metric, e.g. the loss and phase timings
+# Other processes (e.g. the validation worker) can append to the same file.
+# A resumed run drops the epoch and batch metrics of the steps it repeats.
+# Metrics of runs started before the store existed are imported from the CSVs.
+
+class MetricsStore():
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60.0)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS epochs (epoch INTEGER, name TEXT, value REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS batches (epoch INTEGER, batch INTEGER, mode TEXT, name TEXT, value REAL)")
+        self.conn.commit()
+        self.pending_batches = []
+        self.last_rowids = {}
+
+    def is_empty(self):
+        return self.conn.execute("SELECT COUNT(*) FROM epochs").fetchone()[0] == 0
+
+    def log_epoch(self, epoch, **values):
+        self.conn.executemany("INSERT INTO epochs VALUES (?,?,?)",
+                              [(epoch, k, float(v)) for k,v in values.items()])
+        self.conn.commit()
+
+    def log_batch(self, epoch, batch, mode, **values):
+        # Buffered, written with the next commit()
+        self.pending_batches += [(epoch, batch, mode, k, float(v)) for k,v in values.items()]
+
+    def commit(self):
+        if(len(self.pending_batches) > 0):
+            self.conn.executemany("INSERT INTO batches VALUES (?,?,?,?,?)", self.pending_batches)
+            self.pending_batches = []
+        self.conn.commit()
+
+    def series(self, name):
+        # (epoch, value) sorted by epoch, the latest value wins if an epoch was repeated after a resume
+        values = {}
+        for epoch,value in self.conn.execute("SELECT epoch, value FROM epochs WHERE name=? ORDER BY rowid", (name,)):
+            values[epoch] = value
+        return sorted(values.items())
+
+    def follow(self, name):
+        # (epoch, value) appended since the last call, e.g. by another process,
+        # only the latest value of an epoch that was logged several times
+        last_rowid = self.last_rowids.get(name, 0)
+        rows = self.conn.execute("SELECT rowid, epoch, value FROM epochs WHERE name=? AND rowid>? ORDER BY rowid",
+                                 (name, last_rowid)).fetchall()
+        if(len(rows) > 0):
+            self.last_rowids[name] = rows[-1][0]
+        latest = {r[1]: i for i,r in enumerate(rows)}
+        return [(r[1], r[2]) for i,r in enumerate(rows) if latest[r[1]] == i]
+
+    def truncate_epochs(self, epoch, step=0):
+        # Drop the metrics from epoch on, which are repeated after a resume,
+        # the batches before step were kept by a step checkpoint
+        self.conn.execute("DELETE FROM epochs WHERE epoch>=?", (epoch,))
+        self.conn.execute("DELETE FROM batches WHERE epoch>? OR (epoch=? AND batch>=?)", (epoch, epoch, step))
+        self.conn.commit()
+
+    def names(self):
+        return [r[0] for r in self.conn.execute("SELECT DISTINCT name FROM epochs")]
+
+    def import_csvs(self, output_path):
+        # Single column CSVs written by append2file, one line per epoch
+        def readColumn(file_name):
+            if(not os.path.exists(file_name)):
+                return []
+            with open(file_name) as f:
+                return [float(l[0]) for l in csv.reader(f, delimiter='\n') if len(l) > 0]
+
+        for name,file_name in [("train_loss", "train-loss.csv"), ("lr", "learning-rate.csv")]:
+            for epoch,value in enumerate(readColumn(os.path.join(output_path, file_name))):
+                self.log_epoch(epoch, **{name: value})
+        val_losses = readColumn(os.path.join(output_path, "validation-loss.csv"))
+        val_epochs = [int(e) for e in readColumn(os.path.join(output_path, "validation-epochs.csv"))]
+        if(len(val_epochs) != len(val_losses)): # Older runs validated every epoch
+            val_epochs = list(range(len(val_losses)))
+        for epoch,value in zip(val_epochs, val_losses):
+            self.log_epoch(epoch, val_loss=value)
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+class RunningMean():
+    # Window means in constant time from a cumulative sum
+    def __init__(self, values=[]):
+        self.cumsum = [0.0]
+        for v in values:
+            self.append(v)
+
+    def __len__(self):
+        return len(self.cumsum) - 1
+
+    def append(self, value):
+        self.cumsum.append(self.cumsum[-1] + value)
+
+    def window_mean(self, start, end):
+        return (self.cumsum[end] - self.cumsum[start])/(end - start)
+
+def plotSeries(store, file_name, names):
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(8, 5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    ax.grid(True)
+    for name,label in names:
+        series = store.series(name)
+        if(len(series) > 0):
+            ax.plot([s[0] for s in series], [s[1] for s in series], label=label)
+    ax.set_xlabel('epochs')
+    ax.set_ylabel('loss')
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(file_name, dpi=fig.dpi)
+
+class LossPlotter():
+    # Redraws the loss plots from the metrics store on a background thread,
+    # requests arriving while drawing are merged into a single redraw
+    def __init__(self, store_path, output_path):
+        self.store_path = store_path
+        self.output_path = output_path
+        self.requested = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self):
+        self.requested.set()
+
+    def close(self):
+        self.stopping = True
+        self.requested.set()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            self.requested.wait()
+            self.requested.clear()
+            stopping = self.stopping
+            try:
+                self.plot()
+            except Exception as e:
+                print("Plotting the losses failed: {0}".format(e))
+            if(stopping):
+                break
+
+    def plot(self):
+        # sqlite connections can not be shared between threads
+        store = MetricsStore(self.store_path)
+        plotSeries(store, os.path.join(self.output_path, "train-loss.png"),
+                   [("train_loss", "train"), ("val_loss", "validation")])
+        obj_names = sorted([n for n in store.names() if n.startswith("val_obj")])
+        for name in obj_names:
+            plotSeries(store, os.path.join(self.output_path, "validation-{0}.png".format(name[4:].replace("_", "-"))),
+                       [("train_loss", "train"), (name, "validation")])
+        store.close()
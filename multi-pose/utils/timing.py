@@ -0,0 +1,101 @@
+import time
+import json
+import contextlib
+import collections
+import torch
+
+# Per-phase timing of the training loop
+#
+# Phases can be nested, the time of a nested phase is only counted for the
+# inner phase (e.g. the renders inside of the loss are not counted as loss
+# math). When sync is set, CUDA is synchronized at every phase boundary so
+# the asynchronous kernels are attributed to the phase that launched them.
+# This costs some throughput, so timing is disabled by default.
+# A utils.memory.MemoryTracker can be attached to account memory per phase.
+
+class PhaseTimer():
+    def __init__(self):
+        self.enabled = False
+        self.sync = True
+        self.device = None
+        self.memory = None
+        self.stack = []
+        self.reset_epoch()
+
+    def reset_epoch(self):
+        self.epoch_times = collections.OrderedDict()
+        self.batch_times = collections.OrderedDict()
+        self.num_samples = 0
+        self.epoch_start = time.perf_counter()
+
+    def active(self):
+        return self.enabled or self.memory is not None
+
+    def synchronize(self):
+        if(self.enabled and self.sync and self.device is not None and self.device.type == "cuda"):
+            torch.cuda.synchronize(self.device)
+
+    def add(self, name, seconds):
+        if(not self.enabled):
+            return
+        self.batch_times[name] = self.batch_times.get(name, 0.0) + seconds
+        self.epoch_times[name] = self.epoch_times.get(name, 0.0) + seconds
+
+    # start() and stop() are for phases which do not fit a with block
+    def start(self):
+        if(not self.active()):
+            return
+        self.synchronize()
+        if(self.memory is not None):
+            self.memory.begin()
+        self.stack.append([time.perf_counter(), 0.0]) # Start and time spent in nested phases
+
+    def stop(self, name):
+        if(not self.active()):
+            return
+        self.synchronize()
+        start, nested = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        self.add(name, elapsed - nested)
+        if(len(self.stack) > 0):
+            self.stack[-1][1] += elapsed
+        if(self.memory is not None):
+            self.memory.end(name)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if(not self.active()):
+            yield
+            return
+
+        self.start()
+        try:
+            with torch.autograd.profiler.record_function(name):
+                yield
+        finally:
+            self.stop(name)
+
+    def end_batch(self, num_samples):
+        # Returns the phase times of the finished batch
+        self.num_samples += num_samples
+        times = self.batch_times
+        self.batch_times = collections.OrderedDict()
+        return times
+
+    def summary(self):
+        wall_time = time.perf_counter() - self.epoch_start
+        shares = collections.OrderedDict()
+        for name,seconds in self.epoch_times.items():
+            shares[name] = seconds/wall_time if wall_time > 0 else 0.0
+        shares["other"] = max(0.0, 1.0 - sum(shares.values()))
+        return {"wall_time": wall_time,
+                "num_samples": self.num_samples,
+                "samples_per_sec": self.num_samples/wall_time if wall_time > 0 else 0.0,
+                "shares": shares}
+
+def appendJson(record, file_name):
+    with open(file_name, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+# Shared by the training loop, the pipeline and the loss
+timer = PhaseTimer()
@@ -61,7 +61,7 @@ def compute_pose_from_rotation_matrix(T_pose, r_matrix):
 def normalize_vector( v):
     batch=v.shape[0]
     v_mag = torch.sqrt(v.pow(2).sum(1))# batch
-    v_mag = torch.max(v_mag, torch.autograd.Variable(torch.FloatTensor([1e-8]).cuda()))
+    v_mag = torch.max(v_mag, torch.autograd.Variable(torch.FloatTensor([1e-8]).to(v.device)))
     v_mag = v_mag.view(batch,1).expand(batch,v.shape[1])
     v = v/v_mag
     return v
@@ -83,6 +83,8 @@ def cross_product( u, v):
 #poses batch*6
 #poses
 def compute_rotation_matrix_from_ortho6d(poses):
+    # Always convert in fp32, also when the network runs in reduced precision
+    poses = poses.float()
     x_raw = poses[:,0:3]#batch*3
 
     # SHBE - fix, x cannot be zero
@@ -90,7 +92,7 @@ def compute_rotation_matrix_from_ortho6d(poses):
         dim=1, keepdim=True
     )
     if is_close.any():
-        replacement = torch.tensor([1.0, 0.0, 0.0]).repeat(x_raw.shape[0],1).cuda()
+        replacement = torch.tensor([1.0, 0.0, 0.0]).repeat(x_raw.shape[0],1).to(poses.device)
         x_raw = torch.where(is_close, replacement, x_raw)
 
     y_raw = poses[:,3:6]#batch*3
@@ -100,7 +102,7 @@ def compute_rotation_matrix_from_ortho6d(poses):
         dim=1, keepdim=True
     )
     if is_close.any():
-        replacement = torch.tensor([0.0, 1.0, 0.0]).repeat(y_raw.shape[0],1).cuda()
+        replacement = torch.tensor([0.0, 1.0, 0.0]).repeat(y_raw.shape[0],1).to(poses.device)
         y_raw = torch.where(is_close, replacement, y_raw)
 
     x = normalize_vector(x_raw) #batch*3
@@ -111,13 +113,13 @@ def compute_rotation_matrix_from_ortho6d(poses):
         dim=1, keepdim=True
     )
     if is_close.any():
-        replacement = torch.tensor([1.0, 0.0, 0.0]).repeat(x.shape[0],1).cuda()
+        replacement = torch.tensor([1.0, 0.0, 0.0]).repeat(x.shape[0],1).to(poses.device)
         x = torch.where(is_close, replacement, x)
 
         # replacement = torch.tensor([0.0, 1.0, 0.0]).repeat(y.shape[0],1).cuda()
         # y = torch.where(is_close, replacement, y)
 
-        replacement = torch.tensor([0.0, 0.0, 1.0]).repeat(z.shape[0],1).cuda()
+        replacement = torch.tensor([0.0, 0.0, 1.0]).repeat(z.shape[0],1).to(poses.device)
         z = torch.where(is_close, replacement, z)
 
 
@@ -343,21 +345,25 @@ def get_44_rotation_matrix_from_33_rotation_matrix(m):
 #both matrix are orthogonal rotation matrices
 #out theta between 0 to 180 degree batch
 def compute_geodesic_distance_from_two_matrices(m1, m2):
-    batch=m1.shape[0]
-    m = torch.bmm(m1, m2.transpose(1,2)) #batch*3*3
+    return compute_geodesic_distance(m1, m2)
 
-    cos = (  m[:,0,0] + m[:,1,1] + m[:,2,2] - 1 )/2
-    cos = torch.min(cos, torch.autograd.Variable(torch.ones(batch).cuda()) )
-    cos = torch.max(cos, torch.autograd.Variable(torch.ones(batch).cuda())*-1 )
+#matrices ...*3*3, any broadcastable batch dimensions and on any device
+#cos is clamped to [-1+epsilon, 1-epsilon], epsilon > 0 keeps the gradient of acos finite
+#out theta in radians ...
+def compute_geodesic_distance(m1, m2, epsilon=0.0):
+    m = torch.matmul(m1, m2.transpose(-1,-2)) #...*3*3
 
+    cos = (torch.diagonal(m, dim1=-2, dim2=-1).sum(-1) - 1)/2
+    cos = torch.clamp(cos, -1 + epsilon, 1 - epsilon)
 
     theta = torch.acos(cos)
-
-    #theta = torch.min(theta, 2*np.pi - theta)
-
-
     return theta
 
+#matrices batch*n*3*3
+#out theta between every pair of the n matrices batch*n*n, theta[:,k,i] of m[:,k]*m[:,i]^T
+def compute_pairwise_geodesic_distance(m, epsilon=0.0):
+    return compute_geodesic_distance(m.unsqueeze(-3), m.unsqueeze(-4), epsilon)
+
 
 #matrices batch*3*3
 #both matrix are orthogonal rotation matrices
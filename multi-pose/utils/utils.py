@@ -8,6 +8,7 @@ import os
 
 import math
 import numbers
+import contextlib
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -220,6 +221,21 @@ def prepareViews(eulerList):
         views.append(rot_mat)
     return views
 
+# Mixed precision context for the encoder and the pose head
+# precision is one of 'fp32', 'bf16' or 'fp16'
+def autocastContext(device, precision="fp32"):
+    if(precision == "fp32"):
+        return contextlib.suppress()
+    if(precision not in ["bf16", "fp16"]):
+        raise ValueError("Unknown precision specified: {0}".format(precision))
+
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float16
+    if(hasattr(torch, "autocast")): # Requires pytorch>=1.10.0, needed for bf16 and cpu
+        return torch.autocast(device_type=device.type, dtype=dtype)
+    if(device.type == "cuda" and precision == "fp16"):
+        return torch.cuda.amp.autocast()
+    raise ValueError("Precision {0} on {1} requires pytorch>=1.10.0".format(precision, device.type))
+
 def batch(iterable, n=1):
     l = len(iterable)
     for ndx in range(0, l, n):
@@ -283,6 +299,12 @@ def calcMeanVar(br, data, device, t):
     print(torch.std(result))
     return torch.mean(result), torch.std(result)
 
+def toNumpy(x):
+    # Accepts both tensors and numpy arrays
+    if torch.is_tensor(x):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
 def plotView(currView, numViews, vmin, vmax, input_images, groundtruth, predicted, predicted_pose, loss, batch_size, threshold=9999, img_num=0):
     # Plot AE input
     plt.subplot(1, 4, 1)
@@ -291,18 +313,18 @@ def plotView(currView, numViews, vmin, vmax, input_images, groundtruth, predicte
 
     # Plot depth map render from ground truth
     plt.subplot(1, 4, 2)
-    plt.imshow(groundtruth[img_num].detach().cpu().numpy())#,
+    plt.imshow(toNumpy(groundtruth[img_num]))#,
                #vmin=vmin, vmax=vmax)
     plt.title("Depth Render - GT")
 
     # Plot depth map render from prediction
     plt.subplot(1, 4, 3)
-    plt.imshow(predicted[img_num].detach().cpu().numpy())#,
+    plt.imshow(toNumpy(predicted[img_num]))#,
                #vmin=vmin, vmax=vmax)
 
     np.set_printoptions(suppress=True)
     np.set_printoptions(linewidth=30)
-    plt.title("Predicted: \n " + np.array2string((predicted_pose[img_num][:numViews]).detach().cpu().numpy(),precision=2))
+    plt.title("Predicted: \n " + np.array2string(toNumpy(predicted_pose[img_num][:numViews]),precision=2))
 
     # if(currView == 0):
     #     plt.title("Predicted: \n " + np.array2string((predicted_pose[currView*batch_size]).detach().cpu().numpy(),precision=2))
@@ -310,11 +332,11 @@ def plotView(currView, numViews, vmin, vmax, input_images, groundtruth, predicte
     #     plt.title("Predicted")
 
     # Plot difference between depth maps
-    loss_contrib = np.abs((groundtruth[img_num]).detach().cpu().numpy() - (predicted[img_num]).detach().cpu().numpy())
+    loss_contrib = np.abs(toNumpy(groundtruth[img_num]) - toNumpy(predicted[img_num]))
     loss_contrib[loss_contrib > threshold] = threshold
     plt.subplot(1, 4, 4)
     plt.imshow(loss_contrib)#, vmin=0.0, vmax=20.0)
-    plt.title("Loss: \n " + np.array2string((loss[img_num]).detach().cpu().numpy()))
+    plt.title("Loss: \n " + np.array2string(toNumpy(loss[img_num])))
 
 # Convert quaternion to rotation matrix
 # from: https://github.com/ClementPinard/SfmLearner-Pytorch/blob/master/inverse_warp.py